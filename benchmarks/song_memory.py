@@ -0,0 +1,75 @@
+''' Measures the memory cost of queued songs, before and after songs were made compact and interned.
+
+Usage: python benchmarks/song_memory.py [queue entries] [distinct songs]
+'''
+
+import os
+import sys
+import tracemalloc
+
+# `util.env` requires these to be set, but the benchmark never talks to Discord or Subsonic
+os.environ.setdefault("DISCORD_OWNER_ID", "0")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import data # Imported first, like the application does, to resolve the data <-> player import cycle
+
+from player import SongQueue
+from subsonic import Song
+
+
+class LegacySong():
+    ''' The song representation used before songs were compacted: one dict-backed copy per queue entry '''
+    def __init__(self, json_object: dict) -> None:
+        self._id: str = json_object["id"] if "id" in json_object else ""
+        self._title: str = json_object["title"] if "title" in json_object else "Unknown Track"
+        self._album: str = json_object["album"] if "album" in json_object else "Unknown Album"
+        self._artist: str = json_object["artist"] if "artist" in json_object else "Unknown Artist"
+        self._cover_id: str = json_object["coverArt"] if "coverArt" in json_object else ""
+        self._duration: int = json_object["duration"] if "duration" in json_object else 0
+
+
+def song_json(index: int) -> dict:
+    ''' Returns a json object shaped like a song returned by the Subsonic API, as freshly decoded from a response '''
+    album = index // 12
+    return {
+        "id": f"{index:032x}",
+        "title": f"Track number {index}",
+        "album": "".join(["Album number ", str(album)]),
+        "artist": "".join(["Artist number ", str(album // 5)]),
+        "coverArt": "".join(["al-", f"{album:032x}"]),
+        "duration": 180 + index % 120,
+    }
+
+
+def measure(label: str, entries: int, distinct: int, build) -> None:
+    ''' Builds a queue with `build` and reports the memory it retains per entry '''
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+
+    queue = build(entries, distinct)
+
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    retained = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+    print(f"{label:<10} {len(queue):>8} entries  {retained / 1024 / 1024:8.2f} MiB  {retained / len(queue):7.1f} bytes/entry")
+
+
+def build_legacy(entries: int, distinct: int) -> list:
+    # Every search or album lookup produced a new object, and queues were lists
+    return [LegacySong(song_json(i % distinct)) for i in range(entries)]
+
+
+def build_compact(entries: int, distinct: int) -> SongQueue:
+    queue = SongQueue()
+    queue.extend(Song.from_json(song_json(i % distinct)) for i in range(entries))
+    return queue
+
+
+if __name__ == "__main__":
+    entries = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    distinct = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+
+    print(f"Queueing {entries} entries drawn from {distinct} distinct songs")
+    measure("before", entries, distinct, build_legacy)
+    measure("after", entries, distinct, build_compact)
@@ -19,7 +19,7 @@
               discordpy
               pynacl
               python-dotenv
-              requests
+              aiohttp
             ]))
           ];
 
@@ -34,7 +34,7 @@
               discordpy
               pynacl
               python-dotenv
-              requests
+              aiohttp
             ]))
           ];
         };
@@ -0,0 +1,158 @@
+''' A persistent cache of encoded Opus audio, so replayed songs need neither the Subsonic server nor an encoder '''
+
+import io
+import logging
+import shlex
+import subprocess
+import discord
+
+from discord.oggparse import OggError, OggStream
+
+from subsonic import Song
+from util import env
+from util.diskcache import DiskCache
+
+logger = logging.getLogger(__name__)
+
+# Encoded songs stored on disk as Ogg Opus files, keyed by song id, bitrate and gain settings
+opus_cache = DiskCache("cache/audio", env.AUDIO_CACHE_MAX_BYTES, ".ogg")
+
+def cache_key(song: Song, bitrate: int, gain: str) -> str:
+    ''' Returns the key of a song encoded with the given bitrate and gain settings '''
+    return f"{song.song_id}:{bitrate}:{gain}"
+
+def lookup(key: str) -> str:
+    ''' Returns the path of a cached encoding, or None if it isn't cached '''
+    if env.AUDIO_CACHE_MAX_BYTES <= 0 or opus_cache.lookup(key) is None:
+        return None
+    return opus_cache.path(key)
+
+
+class CachedOpusAudio(discord.AudioSource):
+    ''' Plays Opus packets read directly from a cached Ogg file, without spawning FFmpeg '''
+
+    PACKETS_PER_SECOND = 50
+
+    def __init__(self, key: str, position: int=0) -> None:
+        self._key = key
+        self._file = open(opus_cache.path(key), "rb")
+        self._packet_iter = OggStream(self._file).iter_packets()
+
+        # Skip the Ogg Opus header packets, and any audio before the starting position
+        for _ in range(2 + position * self.PACKETS_PER_SECOND):
+            next(self._packet_iter, None)
+
+    def read(self) -> bytes:
+        try:
+            return next(self._packet_iter, b"")
+        except OggError as err:
+            logger.error("Cached audio '%s' is corrupt and will be removed.", self._key, exc_info=err)
+            opus_cache.remove(self._key)
+            return b""
+
+    def is_opus(self) -> bool:
+        return True
+
+    def cleanup(self) -> None:
+        self._file.close()
+
+
+class RecordingOpusAudio(discord.FFmpegAudio):
+    ''' Streams audio through FFmpeg like `discord.FFmpegOpusAudio`, while also recording the encoded stream into the cache
+
+    The recording is only kept if the song was played to the end, its input didn't fail, and it is about as long as the song.
+    '''
+
+    PACKETS_PER_SECOND = 50
+
+    # How many seconds a recording may fall short of the song's duration, which is rounded and often slightly inaccurate
+    DURATION_TOLERANCE = 2
+
+    def __init__(self, source: str | io.BufferedIOBase, key: str, *, duration: int=0, bitrate: int=128, codec: str=None, pipe: bool=False, before_options: str=None, options: str=None) -> None:
+        self._key = key
+        self._temp = opus_cache.temp_path(key)
+        self._input = source
+        self._duration = duration
+        self._packets: int = 0
+        self._completed = False
+
+        codec = "copy" if codec in ("opus", "libopus", "copy") else "libopus"
+
+        args = []
+        if before_options is not None:
+            args.extend(shlex.split(before_options))
+
+        args.extend(("-i", "-" if pipe else source,
+                     "-map", "0:a",
+                     "-map_metadata", "-1",
+                     "-c:a", codec,
+                     "-ar", "48000",
+                     "-ac", "2",
+                     "-b:a", f"{bitrate}k",
+                     "-loglevel", "warning"))
+
+        if options is not None:
+            args.extend(shlex.split(options))
+
+        # Encode once, writing the result both to the cache and to Discord. A failing cache write mustn't interrupt playback
+        args.extend(("-f", "tee", f"[f=ogg:onfail=ignore]{self._temp}|[f=opus]pipe:1"))
+
+        try:
+            super().__init__(source, executable="ffmpeg", args=args, stdin=subprocess.PIPE if pipe else subprocess.DEVNULL)
+        except discord.ClientException:
+            opus_cache.discard(self._temp)
+            raise
+
+        self._packet_iter = OggStream(self._stdout).iter_packets()
+
+    def read(self) -> bytes:
+        packet = next(self._packet_iter, b"")
+        if packet:
+            self._packets += 1
+        else:
+            self._completed = True
+        return packet
+
+    def is_opus(self) -> bool:
+        return True
+
+    def cleanup(self) -> None:
+        process = self._process
+
+        # Cleanup may run more than once, but the recording must only be handled the first time
+        if process is discord.utils.MISSING:
+            return
+
+        # Let FFmpeg finish writing the recording if the song played to the end
+        if self._completed:
+            try:
+                process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self._completed = False
+
+        super().cleanup()
+
+        if self._completed and process.returncode == 0 and self._is_whole_song():
+            opus_cache.commit(self._key, self._temp)
+        else:
+            opus_cache.discard(self._temp)
+
+    def _is_whole_song(self) -> bool:
+        ''' Whether the recording holds the whole song, rather than a stream which ended early but cleanly '''
+
+        # A read-ahead buffer which gave up ends FFmpeg's input as if the stream were complete
+        if getattr(self._input, "failed", False):
+            logger.warning("Not caching '%s': the stream failed partway through.", self._key)
+            return False
+
+        # Songs of unknown duration can only be trusted on FFmpeg's word
+        if self._duration <= 0:
+            return True
+
+        expected = self._duration * self.PACKETS_PER_SECOND
+        tolerance = max(self.DURATION_TOLERANCE * self.PACKETS_PER_SECOND, expected // 50)
+        if self._packets < expected - tolerance:
+            logger.warning("Not caching '%s': recorded %.1fs of a %ds song.", self._key, self._packets / self.PACKETS_PER_SECOND, self._duration)
+            return False
+
+        return True
@@ -0,0 +1,211 @@
+''' Autocomplete suggestions for search queries, answered from memory '''
+
+import asyncio
+import logging
+import re
+import unicodedata
+import aiohttp
+
+from discord import app_commands
+
+import subsonic
+
+from subsonic import Album, Artist, ResponseCache, Song
+from util import env
+
+from typing import Union
+
+logger = logging.getLogger(__name__)
+
+# Discord shows at most 25 suggestions, each at most 100 characters long
+MAX_CHOICES = 25
+MAX_CHOICE_LENGTH = 100
+
+
+def normalize(text: str) -> str:
+    ''' Lowercases text and strips accents and punctuation, so that queries match regardless of how they are typed '''
+    text = unicodedata.normalize("NFKD", text.casefold())
+    text = "".join(char for char in text if not unicodedata.combining(char))
+    return " ".join(re.findall(r"\w+", text))
+
+
+class SuggestionIndex():
+    ''' An in-memory index of artist, album and song names, searchable by prefix or by any part of a word
+
+    Words shorter than three characters are looked up by prefix, and longer words by their trigrams.
+    '''
+
+    __slots__ = ("_entries", "_keys", "_trigrams", "_prefixes")
+
+    def __init__(self) -> None:
+        # Each entry is (kind, name shown to the user, value submitted as the query, normalized name)
+        self._entries: list[tuple[str, str, str, str]] = []
+        self._keys: set[tuple[str, str]] = set()
+        self._trigrams: dict[str, set[int]] = {}
+        self._prefixes: dict[str, set[int]] = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @staticmethod
+    def _trigrams_of(word: str) -> set[str]:
+        return {word[i:i + 3] for i in range(len(word) - 2)}
+
+    def add(self, kind: str, name: str, artist: str="") -> None:
+        ''' Adds an artist, album or song to the index, unless it is already present '''
+        display = f"{name} - {artist}" if artist else name
+        if (kind, display) in self._keys:
+            return
+
+        entry_id = len(self._entries)
+        normalized = normalize(display)
+        self._entries.append((kind, display, f"{name} {artist}" if artist else name, normalized))
+        self._keys.add((kind, display))
+
+        for word in normalized.split():
+            for length in (1, 2):
+                self._prefixes.setdefault(word[:length], set()).add(entry_id)
+            for trigram in self._trigrams_of(word):
+                self._trigrams.setdefault(trigram, set()).add(entry_id)
+
+    def add_item(self, item: Union[Song, Album, Artist]) -> None:
+        ''' Adds an item returned by the Subsonic API to the index '''
+        if isinstance(item, Song):
+            self.add("song", item.title, item.artist)
+        elif isinstance(item, Album):
+            self.add("album", item.name, item.artist)
+        elif isinstance(item, Artist):
+            self.add("artist", item.name)
+
+    def lookup(self, query: str, kinds: tuple[str, ...], limit: int=MAX_CHOICES) -> list[tuple[str, str]]:
+        ''' Returns up to `limit` (name, value) pairs of the given kinds which match every word of the query, best matches first '''
+        query = normalize(query)
+        words = query.split()
+        if len(words) == 0:
+            return []
+
+        # Narrow down the candidates using the most selective postings, then check each candidate matches every word
+        postings = []
+        for word in words:
+            if len(word) < 3:
+                postings.append(self._prefixes.get(word, set()))
+            else:
+                postings += [self._trigrams.get(trigram, set()) for trigram in self._trigrams_of(word)]
+
+        postings.sort(key=len)
+        candidates = set(postings[0]).intersection(*postings[1:])
+
+        ranked = []
+        for entry_id in candidates:
+            kind, display, value, normalized = self._entries[entry_id]
+            if kind not in kinds or not all(word in normalized for word in words):
+                continue
+
+            # Prefer names which start with the query, then names where every word starts a word, then anything else
+            entry_words = normalized.split()
+            if normalized.startswith(query):
+                rank = 0
+            elif all(any(entry_word.startswith(word) for entry_word in entry_words) for word in words):
+                rank = 1
+            else:
+                rank = 2
+
+            ranked.append((rank, len(normalized), display, value))
+
+        ranked.sort()
+        return [(display, value) for _, _, display, value in ranked[:limit]]
+
+
+# Suggestions for queries recently answered, keyed by the kinds of item requested
+suggestion_cache = ResponseCache({"autocomplete": env.AUTOCOMPLETE_CACHE_TTL}, env.AUTOCOMPLETE_CACHE_MAX_ITEMS)
+
+_index = SuggestionIndex()
+_index_version: int = 0
+_rebuild_task: asyncio.Task = None
+
+# The latest pending server lookup of each user, so only the last keystroke in a burst reaches the server
+_pending_lookups: dict[int, object] = {}
+
+# The number of names learned from server lookups is capped when there's no library index to build from
+MAX_LEARNED_ENTRIES = 50000
+
+async def _rebuild_from_library() -> None:
+    ''' Replaces the index with one built from every name in the local library index '''
+    global _index, _index_version
+
+    library = subsonic.local_library
+    version = library.version
+
+    def build() -> SuggestionIndex:
+        index = SuggestionIndex()
+        for kind, name, artist in library.names():
+            index.add(kind, name, artist if kind != "artist" else "")
+        return index
+
+    _index = await asyncio.to_thread(build)
+    _index_version = version
+    suggestion_cache.invalidate()
+    logger.info("Built autocomplete index of %d names.", len(_index))
+
+def _refresh_index() -> None:
+    ''' Rebuilds the index in the background whenever the library index has changed '''
+    global _rebuild_task
+
+    library = subsonic.local_library
+    if library is None or not library.ready or library.version == _index_version:
+        return
+
+    if _rebuild_task is None or _rebuild_task.done():
+        _rebuild_task = asyncio.get_event_loop().create_task(_rebuild_from_library())
+
+def _index_covers_library() -> bool:
+    ''' Whether the index was built from the whole library, in which case the server has nothing more to suggest '''
+    return subsonic.local_library is not None and _index_version > 0
+
+async def _lookup_server(user_id: int, query: str) -> bool:
+    ''' Adds the server's search results for a query to the index. Returns False if a newer keystroke from the user superseded the lookup '''
+    token = object()
+    _pending_lookups[user_id] = token
+
+    await asyncio.sleep(env.AUTOCOMPLETE_DEBOUNCE)
+    if _pending_lookups.get(user_id) is not token:
+        return False
+
+    try:
+        results = await asyncio.wait_for(subsonic.search(query, artist_count=10, album_count=10, song_count=MAX_CHOICES), env.AUTOCOMPLETE_TIMEOUT)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+        logger.debug("Autocomplete lookup for '%s' failed.", query, exc_info=err)
+        results = []
+    finally:
+        if _pending_lookups.get(user_id) is token:
+            del _pending_lookups[user_id]
+
+    # Names learned this way are discarded once the index is built from the library
+    if not _index_covers_library() and len(_index) < MAX_LEARNED_ENTRIES:
+        for item in results:
+            _index.add_item(item)
+
+    return True
+
+async def suggest(user_id: int, query: str, kinds: tuple[str, ...]) -> list[app_commands.Choice[str]]:
+    ''' Returns autocomplete choices of the given kinds for a partially typed query '''
+    _refresh_index()
+
+    params = {"query": normalize(query), "kinds": kinds}
+    if not params["query"]:
+        return []
+
+    suggestions = suggestion_cache.get("autocomplete", params)
+    if suggestions is None:
+        suggestions = _index.lookup(query, kinds)
+        complete = True
+
+        # Ask the server when the index can't fill the list, unless the user has kept typing
+        if len(suggestions) < MAX_CHOICES and env.AUTOCOMPLETE_SERVER_LOOKUP and not _index_covers_library():
+            complete = await _lookup_server(user_id, query)
+            suggestions = _index.lookup(query, kinds)
+
+        if complete:
+            suggestion_cache.put("autocomplete", params, suggestions)
+
+    return [app_commands.Choice(name=name[:MAX_CHOICE_LENGTH], value=value[:MAX_CHOICE_LENGTH]) for name, value in suggestions]
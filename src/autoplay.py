@@ -0,0 +1,127 @@
+''' Songs to autoplay, fetched from the Subsonic server in batches ahead of time '''
+
+import asyncio
+import logging
+import aiohttp
+
+from collections import deque
+
+import data
+import recommend
+import subsonic
+
+from subsonic import Song
+from util import env
+
+logger = logging.getLogger(__name__)
+
+
+class CandidatePool():
+    ''' A guild's buffer of autoplay candidates, refilled in the background so the next song is available instantly
+
+    Random candidates are fetched in batches from `getRandomSongs`. Similar candidates are ranked from listening history,
+    topped up from `getSimilarSongs2` when history alone isn't enough, seeded by the most recently played songs at the time of each refill.
+    Candidates which have been played recently are skipped.
+    '''
+
+    # The number of recently played songs used to seed recommendations
+    RECOMMEND_SEEDS = 3
+
+    __slots__ = ("_mode", "_candidates", "_recent", "_recent_ids", "_refill_task")
+
+    def __init__(self) -> None:
+        self._mode: "data.AutoplayMode" = None
+        self._candidates: deque[Song] = deque()
+        self._recent: deque[str] = deque()
+        self._recent_ids: set[str] = set()
+        self._refill_task: asyncio.Task = None
+
+    def __len__(self) -> int:
+        return len(self._candidates)
+
+    def played(self, song: Song) -> None:
+        ''' Records that a song has been played, so it won't be autoplayed again for a while '''
+        if song.song_id in self._recent_ids:
+            self._recent.remove(song.song_id)
+
+        self._recent.append(song.song_id)
+        self._recent_ids.add(song.song_id)
+
+        while len(self._recent) > env.AUTOPLAY_RECENT_HISTORY:
+            self._recent_ids.discard(self._recent.popleft())
+
+    async def take(self, mode: "data.AutoplayMode", seed_id: str=None) -> Song:
+        ''' Returns the next song to autoplay in the given mode, or None if no candidate could be found '''
+
+        # Candidates from another mode no longer apply
+        if mode is not self._mode:
+            self.clear()
+            self._mode = mode
+
+        # Only wait on the server if the pool has run dry
+        if len(self._candidates) == 0:
+            self._start_refill(seed_id)
+            await asyncio.shield(self._refill_task)
+
+        # Prefer a song that hasn't been played recently, but settle for a repeat over nothing
+        song = None
+        while self._candidates and (song is None or song.song_id in self._recent_ids):
+            song = self._candidates.popleft()
+
+        # Top the pool up in the background before it runs out
+        if len(self._candidates) < env.AUTOPLAY_LOW_WATER:
+            self._start_refill(seed_id)
+
+        return song
+
+    def clear(self) -> None:
+        ''' Discards all candidates, and stops any refill in progress '''
+        if self._refill_task is not None:
+            self._refill_task.cancel()
+            self._refill_task = None
+
+        self._candidates.clear()
+
+    def _start_refill(self, seed_id: str) -> None:
+        if self._refill_task is None or self._refill_task.done():
+            self._refill_task = asyncio.get_event_loop().create_task(self._refill(self._mode, seed_id))
+
+    async def _refill(self, mode: "data.AutoplayMode", seed_id: str) -> None:
+        # Seed similar songs from the most recently played song if no seed was given
+        if seed_id is None and self._recent:
+            seed_id = self._recent[-1]
+
+        songs: list[Song] = []
+
+        # Rank similar songs from listening history first, which needs no request to the server
+        if mode is data.AutoplayMode.SIMILAR:
+            seed_ids = list(self._recent)[-self.RECOMMEND_SEEDS:]
+            if seed_id is not None and seed_id not in seed_ids:
+                seed_ids.append(seed_id)
+            songs = recommend.index.similar(seed_ids, env.AUTOPLAY_BATCH_SIZE, exclude=self._recent_ids)
+
+        # Blend in the server's similar songs when history alone can't fill a batch
+        if mode is data.AutoplayMode.SIMILAR and seed_id is not None and len(songs) < env.AUTOPLAY_BATCH_SIZE:
+            try:
+                songs += await subsonic.get_similar_songs(song_id=seed_id, count=env.AUTOPLAY_BATCH_SIZE)
+            except (aiohttp.ClientError, asyncio.TimeoutError, KeyError) as err:
+                logger.warning("Failed to fetch similar songs for autoplay.", exc_info=err)
+
+        # Fall back to random songs when nothing similar could be found
+        if len(songs) == 0:
+            try:
+                songs = await subsonic.get_random_songs(size=env.AUTOPLAY_BATCH_SIZE)
+            except (aiohttp.ClientError, asyncio.TimeoutError, KeyError) as err:
+                logger.warning("Failed to refill autoplay candidates.", exc_info=err)
+                return
+
+        # Skip songs played recently, unless a small library means there's nothing else left to play
+        fresh_songs = [song for song in songs if song.song_id not in self._recent_ids]
+
+        pending_ids = {song.song_id for song in self._candidates}
+        for song in fresh_songs or songs:
+            if song.song_id not in pending_ids:
+                self._candidates.append(song)
+                pending_ids.add(song.song_id)
+
+        logger.debug("Refilled autoplay candidates with %d of %d songs.", len(self._candidates), len(songs))
@@ -0,0 +1,79 @@
+''' Slow interaction handlers, run in the background after acknowledging the interaction '''
+
+import asyncio
+import logging
+import aiohttp
+import discord
+
+import ui
+
+from typing import Awaitable, Callable
+
+from util import env
+
+logger = logging.getLogger(__name__)
+
+# The tasks running on behalf of each user and each guild
+_user_tasks: dict[int, set[asyncio.Task]] = {}
+_guild_tasks: dict[int, set[asyncio.Task]] = {}
+
+def _untrack(tasks: dict[int, set[asyncio.Task]], key: int, task: asyncio.Task) -> None:
+    running = tasks.get(key)
+    if running is not None:
+        running.discard(task)
+        if len(running) == 0:
+            del tasks[key]
+
+async def run_deferred(interaction: discord.Interaction, work: Callable[[], Awaitable[None]], *, ephemeral: bool=False, thinking: bool=True) -> None:
+    ''' Acknowledges an interaction straight away, then runs `work` as a background task which responds with followups
+
+    Discord fails an interaction which isn't acknowledged within 3 seconds, which a slow Subsonic server can easily exceed.
+    Users and guilds may only have a few tasks running at once, beyond which the interaction is turned away.
+    '''
+    user_id, guild_id = interaction.user.id, interaction.guild_id
+
+    if len(_user_tasks.get(user_id, ())) >= env.MAX_TASKS_PER_USER or len(_guild_tasks.get(guild_id, ())) >= env.MAX_TASKS_PER_GUILD:
+        await ui.CmdErr.too_busy(interaction)
+        return
+
+    if not interaction.response.is_done():
+        await interaction.response.defer(ephemeral=ephemeral, thinking=thinking)
+
+    async def run() -> None:
+        try:
+            await work()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+            logger.error("Failed to reach the Subsonic server while handling an interaction.", exc_info=err)
+            await ui.CmdErr.server_unreachable(interaction)
+        except discord.HTTPException as err:
+            logger.error("Failed to respond to an interaction.", exc_info=err)
+        except Exception as err:
+            # The interaction has been deferred, so it must still be answered or the user is left waiting
+            logger.error("An interaction handler failed.", exc_info=err)
+            await ui.CmdErr.command_failed(interaction)
+
+    task = asyncio.get_event_loop().create_task(run())
+    _user_tasks.setdefault(user_id, set()).add(task)
+    _guild_tasks.setdefault(guild_id, set()).add(task)
+
+    def finished(task: asyncio.Task) -> None:
+        _untrack(_user_tasks, user_id, task)
+        _untrack(_guild_tasks, guild_id, task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("An interaction handler failed.", exc_info=task.exception())
+
+    task.add_done_callback(finished)
+
+def stats() -> dict[str, int]:
+    ''' Returns the number of tasks running, and how many users and guilds they belong to '''
+    return {
+        "running": sum(len(tasks) for tasks in _guild_tasks.values()),
+        "users": len(_user_tasks),
+        "guilds": len(_guild_tasks),
+    }
+
+def cancel_all() -> None:
+    ''' Cancels every running task '''
+    for tasks in list(_guild_tasks.values()):
+        for task in list(tasks):
+            task.cancel()
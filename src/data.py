@@ -1,9 +1,6 @@
 ''' Data used throughout the application '''
 
-''' 
-    TODO: Save one properties pickle file per-guild, instead of saving all in one file at once
-'''
-
+import json
 import logging
 import os
 import pickle
@@ -11,8 +8,12 @@ import pickle
 from enum import Enum
 from typing import Final
 
+import recommend
+
 from subsonic import Song
 from player import Player
+from storage import GuildRow, GuildStore, QueueChange
+from util import env
 
 logger = logging.getLogger(__name__)
 
@@ -24,10 +25,8 @@ _default_data: dict[str, any] = {
 class GuildData():
     ''' Class that holds all Submeister data specific to a guild (not saved to disk) '''
     def __init__(self) -> None:
-        self._data = _default_data
+        self._data = dict(_default_data)
         self.player = Player()
-        if self.player.queue is None:
-            self.player.queue = []
 
     @property
     def player(self) -> Player:
@@ -50,9 +49,11 @@ def guild_data(guild_id: int) -> GuildData:
     # Create & store new data object if guild does not already exist
     data = GuildData()
 
-    # Load queue from disk if it exists
-    if guild_properties(guild_id).queue is not None:
-        data.player.queue = guild_properties(guild_id).queue
+    # Load queue from disk if it exists, handing it over to the player
+    properties = guild_properties(guild_id)
+    if properties.queue is not None:
+        data.player.queue = properties.queue
+        properties.queue = None
 
     _guild_data_instances[guild_id] = data
     return _guild_data_instances[guild_id]
@@ -74,7 +75,8 @@ _default_properties: dict[str, any] = {
 class GuildProperties():
     ''' Class that holds all Submeister properties specific to a guild (saved to disk) '''
     def __init__(self) -> None:
-        self._properties = _default_properties
+        self._properties = dict(_default_properties)
+        self._dirty = False
 
     @property
     def autoplay_mode(self) -> AutoplayMode:
@@ -84,9 +86,11 @@ class GuildProperties():
     @autoplay_mode.setter
     def autoplay_mode(self, value: AutoplayMode) -> None:
         self._properties["autoplay-mode"] = value
+        self._dirty = True
 
     @property
     def queue(self) -> list[Song]:
+        '''The guild's queue as loaded from disk, until it is handed over to the guild's player'''
         return self._properties["queue"]
 
     @queue.setter
@@ -103,35 +107,124 @@ def guild_properties(guild_id: int) -> GuildProperties:
     if guild_id in _guild_property_instances:
         return _guild_property_instances[guild_id]
 
-    # Create & store new properties object if guild does not already exist
+    # Create & store new properties object if guild does not already exist, loading its row from disk if there is one
     properties = GuildProperties()
+
+    row = _store.load(guild_id) if _store is not None else None
+    if row is not None:
+        autoplay_mode, queue = row
+        properties.autoplay_mode = AutoplayMode(autoplay_mode)
+        properties.queue = [Song.from_json(json.loads(song)) for song in queue]
+        properties._dirty = False
+
     _guild_property_instances[guild_id] = properties
     return _guild_property_instances[guild_id]
 
-def save_guild_properties_to_disk() -> None:
-    ''' Saves guild properties to disk. '''
 
-    # Copy the queues from each guild data into each guild property
-    for guild_id, properties in _guild_property_instances.items():
-        properties.queue = guild_data(guild_id).player.queue
+# Guild storage
+_store: GuildStore = None
 
-    with open("guild_properties.pickle", "wb") as file:
-        try:
-            pickle.dump(_guild_property_instances, file, protocol=pickle.HIGHEST_PROTOCOL)
-            logger.info("Guild properties saved successfully.")
-        except pickle.PicklingError as err:
-            logger.error("Failed to save guild properties to disk.", exc_info=err)
+def _collect_dirty_guilds() -> list[GuildRow]:
+    ''' Returns a row for every guild whose properties or queue changed since they were last saved. Runs on the storage thread '''
 
-def load_guild_properties_from_disk() -> None:
-    ''' Loads guild properties that have been saved to disk. '''
+    rows: list[GuildRow] = []
 
-    if not os.path.exists("guild_properties.pickle"):
-        logger.info("Unable to load guild properties from disk. File was not found.")
-        return
+    for guild_id, properties in list(_guild_property_instances.items()):
+        changes: list[QueueChange] = []
+
+        # Only the changes made to the queue since it was last saved are written, unless there were too many to keep track of
+        data = _guild_data_instances.get(guild_id)
+        if data is not None:
+            songs, queue_changes = data.player.queue.take_changes()
+            if songs is not None:
+                changes.append(("replace", [json.dumps(song.to_json()) for song in songs]))
+
+            for kind, value in queue_changes:
+                if kind in ("append", "prepend"):
+                    value = [json.dumps(song.to_json()) for song in value]
+                changes.append((kind, value))
+
+        if not properties._dirty and len(changes) == 0:
+            continue
+
+        properties._dirty = False
+        rows.append((guild_id, properties.autoplay_mode.value, changes))
+
+    return rows
+
+def _restore_unsaved_guilds(rows: list[GuildRow]) -> None:
+    ''' Marks guilds whose rows failed to save as dirty again. The queue changes in those rows are lost, so their whole queues are saved next time. Runs on the storage thread '''
+
+    for guild_id, _, _ in rows:
+        properties = _guild_property_instances.get(guild_id)
+        if properties is not None:
+            properties._dirty = True
+
+        data = _guild_data_instances.get(guild_id)
+        if data is not None:
+            data.player.queue.rewrite_on_next_save()
+
+def record_history(guild_id: int, song: Song, skipped: bool=False) -> None:
+    ''' Records a song played or skipped in a guild, both for recommendations and in the stored history '''
+
+    recommend.index.remember(song)
+    recommend.index.add(guild_id, song.song_id, skipped)
+
+    if _store is not None:
+        _store.record_history(guild_id, song.song_id, skipped, json.dumps(song.to_json()))
 
-    with open("guild_properties.pickle", "rb") as file:
+def _load_history() -> None:
+    ''' Rebuilds the recommendation index from the stored history '''
+
+    for song_json in _store.load_songs(env.RECOMMEND_HISTORY_LIMIT):
+        recommend.index.remember(Song.from_json(json.loads(song_json)))
+
+    history = _store.load_history(env.RECOMMEND_HISTORY_LIMIT)
+    for guild_id, song_id, skipped in history:
+        recommend.index.add(guild_id, song_id, skipped)
+
+    logger.info("Loaded %d history entries covering %d songs.", len(history), len(recommend.index))
+
+def _import_pickled_properties(path: str) -> None:
+    ''' Imports guild properties saved to a pickle file by older versions of Submeister, then renames the file so it is only imported once '''
+
+    with open(path, "rb") as file:
         try:
-            _guild_property_instances.update(pickle.load(file))
-            logger.info("Guild properties loaded successfully.")
+            instances: dict[int, GuildProperties] = pickle.load(file)
         except pickle.UnpicklingError as err:
-            logger.error("Failed to load guild properties from disk.", exc_info=err)
+            logger.error("Failed to import guild properties from '%s'.", path, exc_info=err)
+            return
+
+    rows: list[GuildRow] = []
+    for guild_id, properties in instances.items():
+        queue = properties._properties.get("queue") or []
+        rows.append((guild_id, properties._properties["autoplay-mode"].value, [("replace", [json.dumps(song.to_json()) for song in queue])]))
+
+    _store.save(rows)
+    os.replace(path, path + ".imported")
+    logger.info("Imported properties of %d guilds from '%s'.", len(rows), path)
+
+def open_guild_storage(path: str="submeister.db") -> None:
+    ''' Opens the guild storage database, and begins writing changes back to it in the background. '''
+    global _store
+
+    _store = GuildStore(path)
+
+    if os.path.exists("guild_properties.pickle"):
+        _import_pickled_properties("guild_properties.pickle")
+
+    _load_history()
+
+    _store.start_write_behind(_collect_dirty_guilds, _restore_unsaved_guilds, env.STORAGE_FLUSH_INTERVAL)
+    logger.info("Guild storage opened successfully.")
+
+def close_guild_storage() -> None:
+    ''' Saves any outstanding changes and closes the guild storage database. '''
+    global _store
+
+    if _store is None:
+        return
+
+    _store.close()
+    _store = None
+    logger.info("Guild storage closed successfully.")
@@ -1,19 +1,27 @@
 ''' An extention allowing for music playback functionality '''
 
+import asyncio
 import logging
+import re
 import discord
 
+from collections import OrderedDict
+
 from discord import app_commands
 from discord.ext import commands
 
+import autocomplete
+import background
 import data
 import player
 import subsonic
 import ui
+import views
 
-from typing import Union
+from typing import Awaitable, Callable, Union
 
 from submeister import SubmeisterClient
+from util import env
 
 logger = logging.getLogger(__name__)
 
@@ -22,6 +30,9 @@ class MusicCog(commands.Cog):
 
     bot : SubmeisterClient
 
+    # The number of results shown on each page of a search
+    SEARCH_PAGE_SIZE = 10
+
     def __init__(self, bot: SubmeisterClient):
         self.bot = bot
 
@@ -50,6 +61,12 @@ class MusicCog(commands.Cog):
         if interaction.user.voice is None:
             return await ui.CmdErr.user_not_in_voice_channel(interaction)
 
+        # Connecting to the voice channel and searching can be slow, so acknowledge the command first
+        await background.run_deferred(interaction, lambda: self._play(interaction, query))
+
+    async def _play(self, interaction: discord.Interaction, query: str) -> None:
+        ''' Connects to the user's voice channel and queues the track matching the query, once the interaction has been acknowledged '''
+
         # Get a valid voice channel connection
         voice_client = await self.get_voice_client(interaction, should_connect=True)
 
@@ -64,7 +81,7 @@ class MusicCog(commands.Cog):
         if query is None:
 
             # Display error if queue is empty & autoplay is disabled
-            if player.queue == [] and data.guild_properties(interaction.guild_id).autoplay_mode == data.AutoplayMode.NONE:
+            if len(player.queue) == 0 and data.guild_properties(interaction.guild_id).autoplay_mode == data.AutoplayMode.NONE:
                 return await ui.CmdErr.queue_is_empty(interaction)
 
             # Begin playback of queue
@@ -73,7 +90,7 @@ class MusicCog(commands.Cog):
             return
 
         # Send our query to the subsonic API and retrieve a list of 1 song
-        songs = subsonic.search(query, artist_count=0, album_count=0, song_count=1)
+        songs = await subsonic.search(query, artist_count=0, album_count=0, song_count=1)
 
         # Display an error if the query returned no results
         if len(songs) == 0:
@@ -86,76 +103,124 @@ class MusicCog(commands.Cog):
         await ui.CmdRsp.added_to_queue(interaction, songs[0])
         await player.play_audio_queue(interaction, voice_client)
 
-    class SelectionHandler:
-        ''' A callable to implement the callback across all three song selection UI types '''
-        def __init__(self, selection: list[Union[subsonic.Song, subsonic.Album, subsonic.Artist]], selector: discord.ui.Select, owner):
-            self._items = selection
-            self._selector = selector
-            self._owner = owner
+    class ResultSelector(discord.ui.DynamicItem[discord.ui.Select], template=r"(?P<kind>album|artist|search):(?P<token>[0-9a-f]+):(?P<arg>.+):select"):
+        ''' A menu selecting one of the results shown by a message. Its custom ID identifies the results, so it keeps working after its view expires '''
 
-        async def __call__(self, interaction: discord.Interaction) -> None:
-            item = self._items[int(self._selector.values[0])]
+        def __init__(self, kind: str, token: str, arg: str, placeholder: str="Select a result", options: list[discord.SelectOption]=None) -> None:
+            super().__init__(discord.ui.Select(placeholder=placeholder, options=options or [], custom_id=f"{kind}:{token}:{arg}:select"))
+            self.kind = kind
+            self.token = token
+            self.arg = arg
 
-            if isinstance(item, subsonic.Song):
-                # Song selected: Queue it
-                voice_client = await self._owner.get_voice_client(interaction)
+        @classmethod
+        async def from_custom_id(cls, interaction: discord.Interaction, item: discord.ui.Select, match: re.Match[str]) -> "MusicCog.ResultSelector":
+            return cls(match["kind"], match["token"], match["arg"])
 
-                # Don't allow users who aren't in a voice channel with the bot to queue tracks
-                if voice_client is not None and interaction.user.status is None:
-                    return await ui.CmdErr.user_not_in_voice_channel(interaction)
+        async def callback(self, interaction: discord.Interaction) -> None:
+            cog: MusicCog = interaction.client.get_cog("MusicCog")
+            index = int(self.item.values[0])
 
-                # Get the guild's player
-                player = data.guild_data(interaction.guild_id).player
+            async def select(interaction: discord.Interaction, results: object) -> None:
+                items = await cog.shown_items(self.kind, self.token, self.arg, results)
+                if index >= len(items):
+                    await ui.CmdErr.results_expired(interaction)
+                    return
 
-                # Add the selected song to the queue
-                player.queue.append(item)
+                await cog.handle_selection(interaction, items[index])
 
-                # Let the user know a track has been added to the queue
-                await ui.CmdRsp.added_to_queue(interaction, item)
+            await cog.with_view_results(interaction, self.kind, self.token, self.arg, select)
 
-                # Fetch the cover art in advance
-                subsonic.get_album_art_file(item.cover_id)
+    class ResultButton(discord.ui.DynamicItem[discord.ui.Button], template=r"(?P<kind>album|artist|search):(?P<token>[0-9a-f]+):(?P<arg>.+):(?P<action>play_all|prev|next)"):
+        ''' A button acting on the results shown by a message. Its custom ID identifies the results, so it keeps working after its view expires '''
 
-                # Attempt to play the audio queue, if the bot is in the voice channel
-                if voice_client is not None:
-                    await player.play_audio_queue(interaction, voice_client)
-                
-            if isinstance(item, subsonic.Album):
-                # Album selected: launch album UI
-                await self._owner.album_ui(interaction, item)
-            if isinstance(item, subsonic.Artist):
-                # Artist selected: launch artist UI
-                await self._owner.artist_ui(interaction, item)
+        LABELS = {"play_all": "Play All", "prev": "<", "next": ">"}
 
+        def __init__(self, kind: str, token: str, arg: str, action: str) -> None:
+            style = discord.ButtonStyle.primary if action == "play_all" else discord.ButtonStyle.secondary
+            super().__init__(discord.ui.Button(label=self.LABELS[action], style=style, custom_id=f"{kind}:{token}:{arg}:{action}"))
+            self.kind = kind
+            self.token = token
+            self.arg = arg
+            self.action = action
 
-    async def album_ui(self, interaction: discord.Interaction, album: subsonic.Album) -> None:
-        ''' Album UI: lists an album's tracks, and alllows queueing them all '''
-        songs = subsonic.get_album_songs(album)
+        @classmethod
+        async def from_custom_id(cls, interaction: discord.Interaction, item: discord.ui.Button, match: re.Match[str]) -> "MusicCog.ResultButton":
+            return cls(match["kind"], match["token"], match["arg"], match["action"])
 
-        # Dispaly an error if we obtain no results
-        if len(songs) == 0:
-            await ui.CmdErr.msg(interaction, f"No tracks found for album **{album.name}")
-            return
+        async def callback(self, interaction: discord.Interaction) -> None:
+            cog: MusicCog = interaction.client.get_cog("MusicCog")
 
-        # Create a view for our response
-        view = discord.ui.View()
+            async def press(interaction: discord.Interaction, results: object) -> None:
+                match self.action:
+                    case "play_all" if self.kind == "album":
+                        await cog.play_album(interaction, *results)
+                    case "play_all" if self.kind == "artist":
+                        await cog.play_artist(interaction, *results)
+                    case "prev" | "next" if self.kind == "search":
+                        await cog.change_search_page(interaction, self.token, int(self.arg), -1 if self.action == "prev" else 1, results)
 
-        # Create a select menu option for each of our results
-        select_options = ui.parse_subsonic_items_as_selection_options(songs)
+            await cog.with_view_results(interaction, self.kind, self.token, self.arg, press)
 
-        # Create a select menu, populated with our options
-        song_selector = discord.ui.Select(placeholder="Select a track", options=select_options)
-        view.add_item(song_selector)
-        
-        # Instantiate a selection handler for this selection
-        song_selector.callback = self.SelectionHandler(songs, song_selector, self)
+    async def with_view_results(self, interaction: discord.Interaction, kind: str, token: str, arg: str, handler: Callable[[discord.Interaction, object], Awaitable[None]]) -> None:
+        ''' Calls `handler` with the results behind a component. If its view has expired, the results are fetched again in the background first '''
+        results = views.registry.results(token)
+        if results is not None:
+            await handler(interaction, results)
+            return
 
-        # Add a button to queue all songs at once
-        play_all_button = discord.ui.Button(label="Play All", style=discord.ButtonStyle.primary, custom_id="play_all_button")
-        view.add_item(play_all_button)
+        async def rehydrate() -> None:
+            results = await self.fetch_view_results(kind, token, arg)
+            if results is None:
+                await ui.CmdErr.results_expired(interaction)
+                return
 
-        # Add a handler for this button
-        async def play_all(interaction: discord.Interaction) -> None:
+            views.registry.rehydrated(token, results)
+            await handler(interaction, results)
+
+        await background.run_deferred(interaction, rehydrate, thinking=False)
+
+    async def fetch_view_results(self, kind: str, token: str, arg: str) -> object:
+        ''' Rebuilds the results behind an expired view from its cursor. Returns None if they can't be rebuilt '''
+        try:
+            match kind:
+                case "album":
+                    # The album's own details aren't part of the cursor, so take them from its songs, totalling their count and duration
+                    songs = await subsonic.get_album_songs(subsonic.Album({"id": arg}))
+                    if len(songs) == 0:
+                        return None
+                    album = subsonic.Album({"id": arg, "name": songs[0].album, "artist": songs[0].artist, "coverArt": songs[0].cover_id,
+                                            "songCount": len(songs), "duration": sum(song.duration for song in songs)})
+                    return (album, songs)
+                case "artist":
+                    albums = await subsonic.get_artist_albums(subsonic.Artist({"id": arg}))
+                    if len(albums) == 0:
+                        return None
+                    return (subsonic.Artist({"id": arg, "name": albums[0].artist, "albumCount": len(albums)}), albums)
+                case "search":
+                    cursor = views.registry.cursor(token)
+                    if cursor is None:
+                        return None
+                    query, _, max_artists, max_albums, max_songs, _ = cursor
+                    return self.SearchPages(query, self.SEARCH_PAGE_SIZE, max_artists, max_albums, max_songs)
+        except KeyError:
+            # The item no longer exists on the server
+            return None
+
+    async def shown_items(self, kind: str, token: str, arg: str, results: object) -> list[Union[subsonic.Song, subsonic.Album, subsonic.Artist]]:
+        ''' Returns the items listed by a view's select menu '''
+        if kind == "search":
+            cursor = views.registry.cursor(token)
+            if cursor is None or int(arg) >= len(cursor[5]):
+                return []
+            return await results.get(cursor[5][int(arg)])
+
+        return results[1]
+
+    async def handle_selection(self, interaction: discord.Interaction, item: Union[subsonic.Song, subsonic.Album, subsonic.Artist]) -> None:
+        ''' Implements selecting an item across all three selection UI types '''
+
+        if isinstance(item, subsonic.Song):
+            # Song selected: Queue it
             voice_client = await self.get_voice_client(interaction)
 
             # Don't allow users who aren't in a voice channel with the bot to queue tracks
@@ -165,184 +230,301 @@ class MusicCog(commands.Cog):
             # Get the guild's player
             player = data.guild_data(interaction.guild_id).player
 
-            # Add the selected album to the queue
-            for song in songs:
-                player.queue.append(song)
+            # Add the selected song to the queue
+            player.queue.append(item)
 
             # Let the user know a track has been added to the queue
-            await ui.CmdRsp.added_album_to_queue(interaction, album)
+            await ui.CmdRsp.added_to_queue(interaction, item)
 
             # Fetch the cover art in advance
-            subsonic.get_album_art_file(album.cover_id)
+            await subsonic.get_album_art_file(item.cover_id)
 
             # Attempt to play the audio queue, if the bot is in the voice channel
             if voice_client is not None:
                 await player.play_audio_queue(interaction, voice_client)
 
-        play_all_button.callback = play_all
+        if isinstance(item, subsonic.Album):
+            # Album selected: launch album UI
+            await self.album_ui(interaction, item)
+        if isinstance(item, subsonic.Artist):
+            # Artist selected: launch artist UI
+            await self.artist_ui(interaction, item)
+
+
+    class SearchPages:
+        ''' The pages of results for one search, cached by their offsets and fetched a page ahead of the user '''
+
+        # Only a few pages are kept per search, so long-lived search messages can't grow without bound
+        MAX_CACHED_PAGES = 8
+
+        def __init__(self, query: str, page_size: int, max_artists: int=None, max_albums: int=None, max_songs: int=None):
+            self._query = query
+            self._page_size = page_size
+            self._max_artists = max_artists
+            self._max_albums = max_albums
+            self._max_songs = max_songs
+            self._pages: OrderedDict[tuple[int, int, int], asyncio.Task] = OrderedDict()
+
+        def _limit(self, maximum: int, seen: int) -> int:
+            ''' Computes how many results of one type to obtain, given how many have been seen already '''
+            return self._page_size if maximum is None else min(self._page_size, max(0, maximum - seen))
+
+        async def _fetch(self, cursor: tuple[int, int, int]) -> list[Union[subsonic.Song, subsonic.Album, subsonic.Artist]]:
+            artists_seen, albums_seen, songs_seen = cursor
+            return (await subsonic.search(self._query, artist_count = self._limit(self._max_artists, artists_seen), artist_offset = artists_seen,
+                                          album_count = self._limit(self._max_albums, albums_seen), album_offset = albums_seen,
+                                          song_count = self._limit(self._max_songs, songs_seen), song_offset = songs_seen))[:self._page_size]
+
+        def _start_fetch(self, cursor: tuple[int, int, int]) -> asyncio.Task:
+            task = asyncio.get_event_loop().create_task(self._fetch(cursor))
+            self._pages[cursor] = task
+
+            # Forget the least recently viewed pages
+            while len(self._pages) > self.MAX_CACHED_PAGES:
+                _, evicted = self._pages.popitem(last=False)
+                evicted.cancel()
+
+            return task
+
+        async def get(self, cursor: tuple[int, int, int]) -> list[Union[subsonic.Song, subsonic.Album, subsonic.Artist]]:
+            ''' Returns the page of results starting at the given (artist, album, song) offsets '''
+            task = self._pages.get(cursor)
+
+            # Fetch the page unless it is cached or already being fetched. Failed fetches are retried
+            if task is None or (task.done() and (task.cancelled() or task.exception() is not None)):
+                task = self._start_fetch(cursor)
+
+            self._pages.move_to_end(cursor)
+            return await asyncio.shield(task)
+
+        def prefetch(self, cursor: tuple[int, int, int]) -> None:
+            ''' Begins fetching a page in the background, so it is ready by the time the user asks for it '''
+            if cursor not in self._pages:
+                self._start_fetch(cursor)
+
+        @staticmethod
+        def next_cursor(cursor: tuple[int, int, int], results: list[Union[subsonic.Song, subsonic.Album, subsonic.Artist]]) -> tuple[int, int, int]:
+            ''' Returns the offsets of the page following the given page '''
+            artists_seen, albums_seen, songs_seen = cursor
+            return (artists_seen + len([e for e in results if isinstance(e, subsonic.Artist)]),
+                    albums_seen + len([e for e in results if isinstance(e, subsonic.Album)]),
+                    songs_seen + len([e for e in results if isinstance(e, subsonic.Song)]))
+
+
+    async def album_ui(self, interaction: discord.Interaction, album: subsonic.Album) -> None:
+        ''' Album UI: lists an album's tracks, and alllows queueing them all '''
+        await background.run_deferred(interaction, lambda: self._album_ui(interaction, album), ephemeral=True)
+
+    async def _album_ui(self, interaction: discord.Interaction, album: subsonic.Album) -> None:
+        ''' Fetches an album's tracks and shows the album UI, once the interaction has been acknowledged '''
+        songs = await subsonic.get_album_songs(album)
+
+        # Dispaly an error if we obtain no results
+        if len(songs) == 0:
+            await ui.CmdErr.msg(interaction, f"No tracks found for album **{album.name}")
+            return
+
+        # Keep the tracks while the view is in use. Its components carry the album's ID, so they can fetch the tracks again later
+        token = views.registry.register((album, songs))
+
+        # Create a view for our response, with a select menu of the tracks and a button to queue all of them at once
+        view = discord.ui.View(timeout=None)
+        view.add_item(self.ResultSelector("album", token, album.album_id, "Select a track", ui.parse_subsonic_items_as_selection_options(songs)))
+        view.add_item(self.ResultButton("album", token, album.album_id, "play_all"))
 
         # Generate a formatted embed for the current search results
         song_list = ui.parse_subsonic_items_as_selection_embed(songs, f"{album.artist} - **{album.name}**", "")
 
         # Show our song selection menu
-        await interaction.response.send_message(embed=song_list, view=view, ephemeral=True)
+        await interaction.followup.send(embed=song_list, view=view, ephemeral=True)
 
-    async def artist_ui(self, interaction: discord.Interaction, artist: subsonic.Artist) -> None:
-        ''' Artist UI: lists an artist's albums, and allows queueing all their tracks '''
-        albums = subsonic.get_artist_albums(artist)
+    async def play_album(self, interaction: discord.Interaction, album: subsonic.Album, songs: list[subsonic.Song]) -> None:
+        ''' Queues every track of an album '''
+        voice_client = await self.get_voice_client(interaction)
 
-        # Dispaly an error if we obtain no results
-        if len(albums) == 0:
-            await ui.CmdErr.msg(interaction, f"No albums found for artist **{artist.name}")
-            return
+        # Don't allow users who aren't in a voice channel with the bot to queue tracks
+        if voice_client is not None and interaction.user.status is None:
+            return await ui.CmdErr.user_not_in_voice_channel(interaction)
 
-        # Create a view for our response
-        view = discord.ui.View()
+        # Get the guild's player
+        player = data.guild_data(interaction.guild_id).player
 
-        # Create a select menu option for each of our results
-        select_options = ui.parse_subsonic_items_as_selection_options(albums)
+        # Add the selected album to the queue
+        player.queue.extend(songs)
 
-        # Create a select menu, populated with our options
-        album_selector = discord.ui.Select(placeholder="Select an album", options=select_options)
-        view.add_item(album_selector)
-        
-        # Instantiate a selection handler for this selection
-        album_selector.callback = self.SelectionHandler(albums, album_selector, self)
+        # Let the user know a track has been added to the queue
+        await ui.CmdRsp.added_album_to_queue(interaction, album)
 
-        # Add a button to queue all albums at once
-        play_all_button = discord.ui.Button(label="Play All", style=discord.ButtonStyle.primary, custom_id="play_all_button")
-        view.add_item(play_all_button)
+        # Fetch the cover art in advance
+        await subsonic.get_album_art_file(album.cover_id)
 
-        # Add a handler for this button
-        async def play_all(interaction: discord.Interaction) -> None:
-            voice_client = await self.get_voice_client(interaction)
+        # Attempt to play the audio queue, if the bot is in the voice channel
+        if voice_client is not None:
+            await player.play_audio_queue(interaction, voice_client)
 
-            # Don't allow users who aren't in a voice channel with the bot to queue tracks
-            if voice_client is not None and interaction.user.status is None:
-                return await ui.CmdErr.user_not_in_voice_channel(interaction)
+    async def artist_ui(self, interaction: discord.Interaction, artist: subsonic.Artist) -> None:
+        ''' Artist UI: lists an artist's albums, and allows queueing all their tracks '''
+        await background.run_deferred(interaction, lambda: self._artist_ui(interaction, artist), ephemeral=True)
 
-            # Get the guild's player
-            player = data.guild_data(interaction.guild_id).player
+    async def _artist_ui(self, interaction: discord.Interaction, artist: subsonic.Artist) -> None:
+        ''' Fetches an artist's albums and shows the artist UI, once the interaction has been acknowledged '''
+        albums = await subsonic.get_artist_albums(artist)
 
-            # Add all albums to the queue
-            for album in albums:
-                for song in subsonic.get_album_songs(album):
-                    player.queue.append(song)
-                await ui.CmdRsp.added_album_to_queue(interaction, album)
-                subsonic.get_album_art_file(album.cover_id)
+        # Dispaly an error if we obtain no results
+        if len(albums) == 0:
+            await ui.CmdErr.msg(interaction, f"No albums found for artist **{artist.name}")
+            return
 
-            # Attempt to play the audio queue, if the bot is in the voice channel
-            if voice_client is not None:
-                await player.play_audio_queue(interaction, voice_client)
+        # Keep the albums while the view is in use. Its components carry the artist's ID, so they can fetch the albums again later
+        token = views.registry.register((artist, albums))
 
-        play_all_button.callback = play_all
+        # Create a view for our response, with a select menu of the albums and a button to queue all of them at once
+        view = discord.ui.View(timeout=None)
+        view.add_item(self.ResultSelector("artist", token, artist.artist_id, "Select an album", ui.parse_subsonic_items_as_selection_options(albums)))
+        view.add_item(self.ResultButton("artist", token, artist.artist_id, "play_all"))
 
         # Generate a formatted embed for the current search results
         album_list = ui.parse_subsonic_items_as_selection_embed(albums, f"**{artist.name}**", "")
 
         # Show our album selection menu
-        await interaction.response.send_message(embed=album_list, view=view, ephemeral=True)
+        await interaction.followup.send(embed=album_list, view=view, ephemeral=True)
+
+    async def play_artist(self, interaction: discord.Interaction, artist: subsonic.Artist, albums: list[subsonic.Album]) -> None:
+        ''' Queues every album by an artist, reporting progress as each album is fetched '''
+        voice_client = await self.get_voice_client(interaction)
+
+        # Don't allow users who aren't in a voice channel with the bot to queue tracks
+        if voice_client is not None and interaction.user.status is None:
+            return await ui.CmdErr.user_not_in_voice_channel(interaction)
+
+        # Get the guild's player
+        player = data.guild_data(interaction.guild_id).player
+
+        # Acknowledge the button straight away, as fetching every album can outlast the interaction's deadline
+        await background.run_deferred(interaction, lambda: self._play_artist(interaction, artist, albums, voice_client, player), thinking=False)
+
+    async def _play_artist(self, interaction: discord.Interaction, artist: subsonic.Artist, albums: list[subsonic.Album], voice_client: discord.VoiceClient, player: player.Player) -> None:
+        progress = ui.ProgressMsg(interaction, f"{interaction.user.display_name} added albums by {artist.name} to queue")
+        await progress.update(f"Fetching {len(albums)} albums...")
+
+        # Fetch the albums concurrently, a few at a time, along with their cover art
+        semaphore = asyncio.Semaphore(env.PLAY_ALL_CONCURRENCY)
+
+        async def fetch_album(album: subsonic.Album) -> list[subsonic.Song]:
+            ''' Returns the album's songs, or None if the album couldn't be fetched. One bad album mustn't stop the rest from being queued '''
+            async with semaphore:
+                try:
+                    songs = await subsonic.get_album_songs(album)
+                except Exception as err:
+                    logger.warning("Failed to fetch album '%s', skipping it.", album.album_id, exc_info=err)
+                    return None
+
+                # Missing cover art is no reason to skip the album
+                try:
+                    await subsonic.get_album_art_file(album.cover_id)
+                except Exception as err:
+                    logger.debug("Failed to fetch the cover art of album '%s'.", album.album_id, exc_info=err)
+
+                return songs
+
+        fetches = [asyncio.create_task(fetch_album(album)) for album in albums]
+        queued_songs = 0
+        skipped_albums = 0
+        started = False
+
+        try:
+            # Add the albums to the queue in order, each as soon as it and the albums before it have been fetched
+            for album_number, (album, fetch) in enumerate(zip(albums, fetches), start=1):
+                songs = await fetch
+                if songs is None:
+                    skipped_albums += 1
+                    songs = []
+
+                player.queue.extend(songs)
+                queued_songs += len(songs)
+
+                # Start playing as soon as there's something to play, rather than waiting for every album
+                if not started and voice_client is not None and len(songs) > 0:
+                    started = True
+                    await player.play_audio_queue(interaction, voice_client)
+
+                skipped = f", {skipped_albums} skipped" if skipped_albums > 0 else ""
+                await progress.update(f"**{album.name}**\nQueued {album_number - skipped_albums} of {len(albums)} albums ({queued_songs} tracks{skipped})", final=album_number == len(albums))
+        finally:
+            for fetch in fetches:
+                fetch.cancel()
 
     async def search_ui(self, interaction: discord.Interaction, query: str, header: str, max_artists = None, max_albums = None, max_songs = None) -> None:
         ''' Generic Search UI to implement search for Songs, Albums or Artists or mixed results '''
-        max_results = 10
-        artists_seen = 0
-        albums_seen = 0
-        songs_seen = 0
-
-        # Compute how many of each type of result to obtain
-        max_artist_results = max_results if max_artists is None else min(max_results, max(0, max_artists - artists_seen))
-        max_album_results = max_results if max_albums is None else min(max_results, max(0, max_albums - albums_seen))
-        max_song_results = max_results if max_songs is None else min(max_results, max(0, max_songs - songs_seen))
-        
-        # Query subsonic
-        results = subsonic.search(query, artist_count = max_artist_results, artist_offset = artists_seen, album_count = max_album_results, album_offset = albums_seen, song_count = max_song_results, song_offset = songs_seen)[:max_results]
+        await background.run_deferred(interaction, lambda: self._search_ui(interaction, query, header, max_artists, max_albums, max_songs), ephemeral=True)
 
-        # Create a view for our response
-        view = discord.ui.View()
+    async def _search_ui(self, interaction: discord.Interaction, query: str, header: str, max_artists: int, max_albums: int, max_songs: int) -> None:
+        ''' Runs a search and shows the search UI, once the interaction has been acknowledged '''
 
-        # Create a select menu option for each of our results
-        select_options = ui.parse_subsonic_items_as_selection_options(results)
+        # Pages are cached while the search's view is in use, keyed by their (artist, album, song) offsets
+        pages = self.SearchPages(query, self.SEARCH_PAGE_SIZE, max_artists, max_albums, max_songs)
 
-        # Create a select menu, populated with our options
-        result_selector = discord.ui.Select(placeholder="Select a result", options=select_options)
-        view.add_item(result_selector)
+        # The cursor records the offsets of each page seen, so the search can be rebuilt once its view expires
+        page_cursors: list[tuple[int, int, int]] = [(0, 0, 0)]
+        token = views.registry.register(pages, (query, header, max_artists, max_albums, max_songs, page_cursors))
 
-        result_selector.callback = self.SelectionHandler(results, result_selector, self)
+        # Query subsonic
+        results = await pages.get(page_cursors[0])
 
-        # Create page navigation buttons
-        prev_button = discord.ui.Button(label="<", custom_id="prev_button")
-        next_button = discord.ui.Button(label=">", custom_id="next_button")
-        view.add_item(prev_button)
-        view.add_item(next_button)
+        # Show our song selection menu
+        result_list, view = self.search_page(token, header, 0, results)
+        await interaction.followup.send(embed=result_list, view=view, ephemeral=True)
 
-        # Callback to handle interactions with page navigator buttons
-        async def page_changed(interaction: discord.Interaction) -> None:
-            nonlocal max_results, artists_seen, albums_seen, songs_seen, results, result_selector
+        # Fetch the next page while the user looks at this one
+        pages.prefetch(pages.next_cursor(page_cursors[0], results))
 
-            # Determine by how much to adjust the "seen" amounts
-            artists_in_result = len([e for e in results if isinstance(e, subsonic.Artist)])
-            albums_in_result = len([e for e in results if isinstance(e, subsonic.Album)])
-            songs_in_result = len([e for e in results if isinstance(e, subsonic.Song)])
+    def search_page(self, token: str, header: str, page: int, results: list[Union[subsonic.Song, subsonic.Album, subsonic.Artist]]) -> tuple[discord.Embed, discord.ui.View]:
+        ''' Generates the embed and view showing one page of search results '''
 
-            # Adjust the search offset according to the button pressed
-            if interaction.data["custom_id"] == "prev_button":
-                if artists_seen <= 0 and albums_seen <= 0 and songs_seen <= 0:
-                    await interaction.response.defer()
-                    return
-                artists_seen -= artists_in_result
-                albums_seen -= albums_in_result
-                songs_seen -= songs_in_result
-            elif interaction.data["custom_id"] == "next_button":
-                artists_seen += artists_in_result
-                albums_seen += albums_in_result
-                songs_seen += songs_in_result
-
-            # Back up previous results before making a new query
-            results_lastpage = results
-
-            # Compute how many of each type of result to obtain
-            max_artist_results = max_results if max_artists is None else min(max_results, max(0, max_artists - artists_seen))
-            max_album_results = max_results if max_albums is None else min(max_results, max(0, max_albums - albums_seen))
-            max_song_results = max_results if max_songs is None else min(max_results, max(0, max_songs - songs_seen))
-            
-            # Query subsonic
-            results = subsonic.search(query, artist_count = max_artist_results, artist_offset = artists_seen, album_count = max_album_results, album_offset = albums_seen, song_count = max_song_results, song_offset = songs_seen)[:max_results]
-
-            # If there are no results on this page, go back one page and don't update the response
-            if len(results) == 0:
-                artists_seen -= artists_in_result
-                albums_seen -= albums_in_result
-                songs_seen -= songs_in_result
-                results = results_lastpage
-                await interaction.response.defer()
-                return
+        # Create a select menu option for each of our results, and page navigation buttons
+        view = discord.ui.View(timeout=None)
+        view.add_item(self.ResultSelector("search", token, str(page), "Select a result", ui.parse_subsonic_items_as_selection_options(results)))
+        view.add_item(self.ResultButton("search", token, str(page), "prev"))
+        view.add_item(self.ResultButton("search", token, str(page), "next"))
 
-            # Generate a new embed containing this page's search results
-            result_list = ui.parse_subsonic_items_as_selection_embed(results, header, f"Page: {((artists_seen + albums_seen + songs_seen) // max_results) + 1}")
+        return ui.parse_subsonic_items_as_selection_embed(results, header, f"Page: {page + 1}"), view
 
-            # Create a selection menu, populated with our new options
-            select_options = ui.parse_subsonic_items_as_selection_options(results)
+    async def change_search_page(self, interaction: discord.Interaction, token: str, page: int, step: int, pages: "MusicCog.SearchPages") -> None:
+        ''' Moves a search UI to the previous or next page '''
+        cursor = views.registry.cursor(token)
+        if cursor is None:
+            await ui.CmdErr.results_expired(interaction)
+            return
 
-            # Update the selector in the existing view
-            view.remove_item(result_selector)
-            result_selector = discord.ui.Select(placeholder="Select a result", options=select_options)
-            result_selector.callback = self.SelectionHandler(results, result_selector, self)
-            view.add_item(result_selector)
+        _, header, _, _, _, page_cursors = cursor
+        new_page = page + step
 
-            # Update the message to show the new search results
-            await interaction.response.edit_message(embed=result_list, view=view)
+        # Find the offsets of the next page the first time it is requested
+        if new_page == len(page_cursors):
+            next_cursor = pages.next_cursor(page_cursors[page], await pages.get(page_cursors[page]))
 
+            # Another press may have found the same page while the results were fetched, so check again before adding it
+            if new_page == len(page_cursors):
+                page_cursors.append(next_cursor)
 
-        # Assign the page_changed callback to the page navigation buttons
-        prev_button.callback = page_changed
-        next_button.callback = page_changed
+        # Get the page from the cache, only querying subsonic if it hasn't been fetched yet
+        new_results = await pages.get(page_cursors[new_page]) if new_page >= 0 else []
 
-        # Generate a formatted embed for the current search results
-        result_list = ui.parse_subsonic_items_as_selection_embed(results, header, f"Page: {((artists_seen + albums_seen + songs_seen) // max_results) + 1}")
+        # If there are no results on this page, stay on the current page and don't update the response
+        if len(new_results) == 0:
+            if not interaction.response.is_done():
+                await interaction.response.defer()
+            return
 
-        # Show our song selection menu
-        await interaction.response.send_message(embed=result_list, view=view, ephemeral=True)
+        # Update the message to show the new search results
+        result_list, view = self.search_page(token, header, new_page, new_results)
+        if interaction.response.is_done():
+            await interaction.edit_original_response(embed=result_list, view=view)
+        else:
+            await interaction.response.edit_message(embed=result_list, view=view)
+
+        # Fetch the next page while the user looks at this one
+        pages.prefetch(pages.next_cursor(page_cursors[new_page], new_results))
 
 
 
@@ -371,6 +553,32 @@ class MusicCog(commands.Cog):
         await self.search_ui(interaction, query, f"**Artist Search:** {query}", None, 0, 0)
 
 
+    @play.autocomplete("query")
+    async def play_autocomplete(self, interaction: discord.Interaction, current: str) -> list[app_commands.Choice[str]]:
+        ''' Suggest tracks while a query for /play is typed '''
+        return await autocomplete.suggest(interaction.user.id, current, ("song",))
+
+    @search.autocomplete("query")
+    async def search_autocomplete(self, interaction: discord.Interaction, current: str) -> list[app_commands.Choice[str]]:
+        ''' Suggest tracks, albums and artists while a query for /search is typed '''
+        return await autocomplete.suggest(interaction.user.id, current, ("artist", "album", "song"))
+
+    @search_song.autocomplete("query")
+    async def search_song_autocomplete(self, interaction: discord.Interaction, current: str) -> list[app_commands.Choice[str]]:
+        ''' Suggest tracks while a query for /search-song is typed '''
+        return await autocomplete.suggest(interaction.user.id, current, ("song",))
+
+    @search_album.autocomplete("query")
+    async def search_album_autocomplete(self, interaction: discord.Interaction, current: str) -> list[app_commands.Choice[str]]:
+        ''' Suggest albums while a query for /search-album is typed '''
+        return await autocomplete.suggest(interaction.user.id, current, ("album",))
+
+    @search_artist.autocomplete("query")
+    async def search_artist_autocomplete(self, interaction: discord.Interaction, current: str) -> list[app_commands.Choice[str]]:
+        ''' Suggest artists while a query for /search-artist is typed '''
+        return await autocomplete.suggest(interaction.user.id, current, ("artist",))
+
+
     @app_commands.command(name="stop", description="Stop playing the current track")
     async def stop(self, interaction: discord.Interaction) -> None:
         ''' Disconnect from the active voice channel '''
@@ -383,8 +591,9 @@ class MusicCog(commands.Cog):
             await ui.CmdErr.bot_not_in_voice_channel(interaction)
             return
 
-        # Disconnect the voice client
+        # Disconnect the voice client, and release the source prepared for the next song
         await interaction.guild.voice_client.disconnect()
+        data.guild_data(interaction.guild_id).player.cancel_prepared()
 
         # Display disconnect confirmation
         await ui.CmdRsp.disconnected(interaction)
@@ -392,31 +601,56 @@ class MusicCog(commands.Cog):
 
     @app_commands.command(name="show-queue", description="View the current queue")
     async def show_queue(self, interaction: discord.Interaction) -> None:
-        ''' Show the current queue '''
+        ''' Show the current queue, one page at a time '''
+        page_size = 10
 
         # Get the audio queue for the current guild
         queue = data.guild_data(interaction.guild_id).player.queue
 
-        # Create a string to store the output of our queue
-        output = ""
+        if len(queue) == 0:
+            await ui.CmdRsp.msg(interaction, "Queue", "Queue is empty!")
+            return
 
-        # Loop over our queue, adding each song into our output string
-        for i, song in enumerate(queue):
-            output += f"{i+1}. **{song.title}** - *{song.artist}*\n{song.album} ({song.duration_printable})\n\n"
+        page = 0
 
-        # Check if our output string is empty & update it accordingly
-        if output == "":
-            output = "Queue is empty!"
+        # Only the visible page is rendered, and the queue is re-read on every page change so it stays current
+        def render() -> discord.Embed:
+            nonlocal page
+            page_count = max(1, -(-len(queue) // page_size))
+            page = min(page, page_count - 1)
 
-        # Show the user their queue
-        await ui.CmdRsp.msg(interaction, "Queue", output)
+            prev_button.disabled = page == 0
+            next_button.disabled = page == page_count - 1
+
+            songs = queue.page(page * page_size, page_size)
+            return ui.parse_queue_page_as_embed(songs, page * page_size, page, page_count, len(queue), queue.duration)
+
+        # Create a view with page navigation buttons
+        view = discord.ui.View()
+        prev_button = discord.ui.Button(label="<", custom_id="prev_button")
+        next_button = discord.ui.Button(label=">", custom_id="next_button")
+        view.add_item(prev_button)
+        view.add_item(next_button)
+
+        # Callback to handle interactions with page navigator buttons
+        async def page_changed(interaction: discord.Interaction) -> None:
+            nonlocal page
+            page = max(0, page - 1) if interaction.data["custom_id"] == "prev_button" else page + 1
+            await interaction.response.edit_message(embed=render(), view=view)
+
+        prev_button.callback = page_changed
+        next_button.callback = page_changed
+
+        # Show the user the first page of their queue
+        await interaction.response.send_message(embed=render(), view=view)
 
 
     @app_commands.command(name="clear-queue", description="Clear the queue")
     async def clear_queue(self, interaction: discord.Interaction) -> None:
         '''Clear the queue'''
-        queue = data.guild_data(interaction.guild_id).player.queue
-        queue.clear()
+        player = data.guild_data(interaction.guild_id).player
+        player.queue.clear()
+        player.cancel_prepared()
 
         # Let the user know that the queue has been cleared
         await ui.CmdRsp.queue_cleared(interaction)
@@ -439,6 +673,11 @@ class MusicCog(commands.Cog):
             await ui.CmdErr.not_playing(interaction)
             return
 
+        # Remember the skip, so similar songs are recommended less often
+        player = data.guild_data(interaction.guild_id).player
+        if player.current_song is not None:
+            data.record_history(interaction.guild_id, player.current_song, skipped=True)
+
         # Stop the current song
         voice_client.stop()
 
@@ -446,6 +685,46 @@ class MusicCog(commands.Cog):
         await ui.CmdRsp.skipping(interaction)
 
 
+    @app_commands.command(name="seek", description="Seek to a position in the current track")
+    @app_commands.describe(position="Enter a position as seconds or mm:ss")
+    async def seek(self, interaction: discord.Interaction, position: str) -> None:
+        ''' Seek to a position in the current track '''
+
+        # Get the voice client instance
+        voice_client = await self.get_voice_client(interaction)
+
+        # Check if the bot is connected to a voice channel
+        if voice_client is None:
+            await ui.CmdErr.bot_not_in_voice_channel(interaction)
+            return
+
+        # Check if the bot is playing music
+        if not voice_client.is_playing():
+            await ui.CmdErr.not_playing(interaction)
+            return
+
+        # Parse the position, accepting either seconds or minutes and seconds
+        try:
+            minutes, _, seconds = position.rpartition(":")
+            seconds = int(minutes or 0) * 60 + int(seconds)
+        except ValueError:
+            await ui.CmdErr.invalid_position(interaction)
+            return
+
+        player = data.guild_data(interaction.guild_id).player
+        if player.current_song is None or seconds < 0 or seconds >= player.current_song.duration:
+            await ui.CmdErr.invalid_position(interaction)
+            return
+
+        # Restart the current song from the requested position
+        if not player.seek(interaction, voice_client, seconds):
+            await ui.CmdErr.cannot_seek(interaction)
+            return
+
+        # Display confirmation message
+        await ui.CmdRsp.seeking(interaction, seconds)
+
+
     @app_commands.command(name="autoplay", description="Toggles autoplay")
     @app_commands.describe(mode="Determines the method to use when autoplaying")
     @app_commands.choices(mode=[
@@ -481,3 +760,6 @@ async def setup(bot: SubmeisterClient):
     ''' Setup function for the music.py cog '''
 
     await bot.add_cog(MusicCog(bot))
+
+    # Answer the components of messages sent before the bot restarted, or whose views have expired
+    bot.add_dynamic_items(MusicCog.ResultSelector, MusicCog.ResultButton)
@@ -6,6 +6,13 @@ import discord
 from discord import app_commands
 from discord.ext import commands
 
+import audiocache
+import background
+import outbox
+import readahead
+import subsonic
+import views
+
 from submeister import SubmeisterClient
 
 from util import env
@@ -117,6 +124,40 @@ class OwnerCog(commands.GroupCog, group_name="owner"):
         await self.bot.tree.sync()
         await interaction.edit_original_response(content="Synchronized commands.")
 
+    @app_commands.command(name="stats")
+    async def stats(self, interaction: discord.Interaction):
+        ''' Shows runtime statistics used to size Submeister's caches '''
+
+        if not await self.is_owner(interaction):
+            return
+
+        sections = {
+            "Response cache": subsonic.response_cache.stats(),
+            "Cover art cache": subsonic.art_cache.stats(),
+            "Audio cache": audiocache.opus_cache.stats(),
+            "Read-ahead buffers": readahead.stats(),
+            "Outbound messages": dict(outbox.stats),
+            "Background tasks": background.stats(),
+            "Views": views.registry.stats(),
+        }
+
+        lines = []
+        for section, section_stats in sections.items():
+            lines.append(f"{section}:")
+            lines += [f"  {name}: {value}" for name, value in section_stats.items()]
+
+        await interaction.response.send_message(content="```\n" + "\n".join(lines) + "\n```", ephemeral=True)
+
+    @app_commands.command(name="clear-cache")
+    async def clear_cache(self, interaction: discord.Interaction):
+        ''' Drops all cached Subsonic responses '''
+
+        if not await self.is_owner(interaction):
+            return
+
+        subsonic.response_cache.invalidate()
+        await interaction.response.send_message(content="Cleared cached Subsonic responses.", ephemeral=True)
+
 async def setup(bot: SubmeisterClient):
     '''Setup function for the owner.py cog'''
 
@@ -0,0 +1,278 @@
+''' A local mirror of the Subsonic library, so searches can be answered without asking the server '''
+
+import asyncio
+import json
+import logging
+import re
+import sqlite3
+import time
+import aiohttp
+
+import subsonic
+
+from subsonic import Album, Artist, Song
+from util import env
+
+from typing import Union
+
+logger = logging.getLogger(__name__)
+
+# Statements to apply for each schema version, in order. The database's `user_version` records the latest version applied
+SCHEMA_MIGRATIONS: list[list[str]] = [
+    # Version 1: artists, albums and songs in one table, indexed for full-text search
+    [
+        '''CREATE TABLE items (
+            rowid INTEGER PRIMARY KEY,
+            kind TEXT NOT NULL,
+            item_id TEXT NOT NULL,
+            album_id TEXT,
+            name TEXT NOT NULL,
+            artist TEXT NOT NULL DEFAULT '',
+            album TEXT NOT NULL DEFAULT '',
+            json TEXT NOT NULL
+        )''',
+        "CREATE INDEX items_album ON items (album_id)",
+        "CREATE INDEX items_kind_name ON items (kind, name)",
+        '''CREATE VIRTUAL TABLE items_fts USING fts5 (
+            kind, name, artist, album,
+            content='items', content_rowid='rowid', tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+        )''',
+        '''CREATE TRIGGER items_insert AFTER INSERT ON items BEGIN
+            INSERT INTO items_fts (rowid, kind, name, artist, album) VALUES (new.rowid, new.kind, new.name, new.artist, new.album);
+        END''',
+        '''CREATE TRIGGER items_delete AFTER DELETE ON items BEGIN
+            INSERT INTO items_fts (items_fts, rowid, kind, name, artist, album) VALUES ('delete', old.rowid, old.kind, old.name, old.artist, old.album);
+        END''',
+        # The signature of each album as of its last sync, used to detect albums which have changed
+        '''CREATE TABLE albums (
+            album_id TEXT PRIMARY KEY,
+            signature TEXT NOT NULL
+        )''',
+        '''CREATE TABLE meta (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        )''',
+    ],
+]
+
+# The order search results are returned in, matching the order of `search3`
+RESULT_KINDS = ("artist", "album", "song")
+
+class LibraryIndex():
+    ''' A full-text index of every artist, album and song in the library, stored in SQLite and synced from the server in the background
+
+    Searches run on the event loop against their own connection, while syncs write through a second connection from a worker thread.
+    '''
+
+    ALBUM_PAGE_SIZE = 500
+    ALBUM_FETCH_CONCURRENCY = 8
+
+    def __init__(self, path: str) -> None:
+        self._path = path
+        self._writer = sqlite3.connect(path, check_same_thread=False)
+        self._writer.execute("PRAGMA journal_mode=WAL")
+        self._writer.execute("PRAGMA synchronous=NORMAL")
+        self._migrate()
+
+        self._reader = sqlite3.connect(path)
+        self._sync_task: asyncio.Task = None
+        self._ready = self._get_meta("synced_at") is not None
+        self._version: int = 1 if self._ready else 0
+
+    @property
+    def ready(self) -> bool:
+        ''' Whether the library has been synced at least once, and can answer searches '''
+        return self._ready
+
+    @property
+    def version(self) -> int:
+        ''' A counter which increases whenever a sync changes the library '''
+        return self._version
+
+    def _migrate(self) -> None:
+        ''' Brings the database schema up to date '''
+        version = self._writer.execute("PRAGMA user_version").fetchone()[0]
+
+        for target, statements in enumerate(SCHEMA_MIGRATIONS[version:], start=version + 1):
+            with self._writer:
+                for statement in statements:
+                    self._writer.execute(statement)
+                self._writer.execute(f"PRAGMA user_version = {target}")
+            logger.info("Migrated library index to schema version %d.", target)
+
+    def _get_meta(self, key: str) -> str:
+        row = self._writer.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row is not None else None
+
+    @staticmethod
+    def _match_expression(query: str) -> str:
+        ''' Converts a search query into an FTS5 expression matching every word as a prefix of a name, artist or album '''
+        words = re.findall(r"\w+", query)
+        return "{name artist album} : (" + " ".join(f'"{word}"*' for word in words) + ")" if words else ""
+
+    def search(self, query: str, *, artist_count: int=20, artist_offset: int=0, album_count: int=20, album_offset: int=0, song_count: int=20, song_offset: int=0) -> list[Union[Song, Album, Artist]]:
+        ''' Searches the library, returning results in the same form as `subsonic.search` '''
+        expression = self._match_expression(query)
+        limits = {
+            "artist": (artist_count, artist_offset),
+            "album": (album_count, album_offset),
+            "song": (song_count, song_offset),
+        }
+
+        results: list[Union[Song, Album, Artist]] = []
+        for kind in RESULT_KINDS:
+            count, offset = limits[kind]
+            if count <= 0:
+                continue
+
+            # An empty query matches everything, as it does for `search3`
+            if expression:
+                # FTS5 ranks every match, then only keeps the requested page
+                rows = self._reader.execute(
+                    '''SELECT items.json FROM items_fts JOIN items ON items.rowid = items_fts.rowid
+                       WHERE items_fts MATCH ? ORDER BY items_fts.rank LIMIT ? OFFSET ?''',
+                    (f"kind : {kind} AND {expression}", count, offset))
+            else:
+                rows = self._reader.execute("SELECT json FROM items WHERE kind = ? ORDER BY name LIMIT ? OFFSET ?", (kind, count, offset))
+
+            for (item_json,) in rows:
+                item = json.loads(item_json)
+                match kind:
+                    case "artist":
+                        results.append(Artist(item))
+                    case "album":
+                        results.append(Album(item))
+                    case "song":
+                        results.append(Song.from_json(item))
+
+        return results
+
+    def names(self) -> list[tuple[str, str, str]]:
+        ''' Returns the kind, name and artist of every item in the library. Safe to call from any thread '''
+        conn = sqlite3.connect(self._path)
+        try:
+            return conn.execute("SELECT kind, name, artist FROM items").fetchall()
+        finally:
+            conn.close()
+
+    def start_sync(self, interval: float) -> None:
+        ''' Starts a background task which syncs the library now, and then periodically '''
+        async def sync_periodically() -> None:
+            while True:
+                try:
+                    await self.sync()
+                except (aiohttp.ClientError, asyncio.TimeoutError, KeyError, sqlite3.Error) as err:
+                    logger.error("Failed to sync the library index.", exc_info=err)
+                await asyncio.sleep(interval)
+
+        self._sync_task = asyncio.get_event_loop().create_task(sync_periodically())
+
+    async def sync(self) -> None:
+        ''' Brings the index up to date with the server, only fetching the albums which have changed '''
+        started_at = time.monotonic()
+
+        # Ask the server whether anything changed since the last sync, which is a single cheap request
+        last_modified = self._get_meta("last_modified")
+        params = {"ifModifiedSince": last_modified} if self._ready and last_modified is not None else {}
+        indexes = (await subsonic._request_json("getIndexes", params))["subsonic-response"].get("indexes", {})
+
+        if self._ready and last_modified is not None and str(indexes.get("lastModified", "")) == last_modified:
+            logger.debug("Library unchanged since the last sync.")
+            return
+
+        artists = await self._fetch_artists()
+        albums = await self._fetch_album_list()
+
+        # Only fetch the songs of albums which are new, or whose details have changed
+        signatures = dict(self._writer.execute("SELECT album_id, signature FROM albums"))
+        changed = [album for album in albums if signatures.get(album["id"]) != self._album_signature(album)]
+        removed = signatures.keys() - {album["id"] for album in albums}
+
+        for start in range(0, len(changed), self.ALBUM_FETCH_CONCURRENCY):
+            batch = changed[start:start + self.ALBUM_FETCH_CONCURRENCY]
+            songs = await asyncio.gather(*(self._fetch_album_songs(album["id"]) for album in batch))
+            await asyncio.to_thread(self._write_albums, list(zip(batch, songs)))
+
+        await asyncio.to_thread(self._write_artists, artists, removed, str(indexes.get("lastModified", "")))
+        self._ready = True
+        self._version += 1
+
+        logger.info("Synced library index in %.1fs: %d artists, %d albums (%d changed, %d removed).",
+                    time.monotonic() - started_at, len(artists), len(albums), len(changed), len(removed))
+
+    @staticmethod
+    def _album_signature(album: dict) -> str:
+        ''' Summarises the details of an album which change when its contents do '''
+        return json.dumps([album.get(field) for field in ("name", "artist", "coverArt", "songCount", "duration", "created", "changed")])
+
+    async def _fetch_artists(self) -> list[dict]:
+        response = await subsonic._request_json("getArtists", {})
+        return [artist for index in response["subsonic-response"]["artists"].get("index", []) for artist in index.get("artist", [])]
+
+    async def _fetch_album_list(self) -> list[dict]:
+        albums: list[dict] = []
+
+        while True:
+            response = await subsonic._request_json("getAlbumList2", {"type": "alphabeticalByName", "size": self.ALBUM_PAGE_SIZE, "offset": len(albums)})
+            page = response["subsonic-response"]["albumList2"].get("album", [])
+            albums += page
+
+            if len(page) < self.ALBUM_PAGE_SIZE:
+                return albums
+
+    async def _fetch_album_songs(self, album_id: str) -> list[dict]:
+        response = await subsonic._request_json("getAlbum", {"id": album_id})
+        return response["subsonic-response"]["album"].get("song", [])
+
+    def _write_albums(self, albums: list[tuple[dict, list[dict]]]) -> None:
+        ''' Replaces the stored albums and their songs. Runs on a worker thread '''
+        with self._writer:
+            for album, songs in albums:
+                self._writer.execute("DELETE FROM items WHERE album_id = ?", (album["id"],))
+
+                album_json = {field: album[field] for field in ("id", "name", "artist", "coverArt", "songCount", "duration") if field in album}
+                self._writer.execute("INSERT INTO items (kind, item_id, album_id, name, artist, json) VALUES ('album', ?, ?, ?, ?, ?)",
+                                     (album["id"], album["id"], album.get("name", ""), album.get("artist", ""), json.dumps(album_json)))
+
+                self._writer.executemany("INSERT INTO items (kind, item_id, album_id, name, artist, album, json) VALUES ('song', ?, ?, ?, ?, ?, ?)",
+                                         [(song["id"], album["id"], song.get("title", ""), song.get("artist", ""), song.get("album", ""), json.dumps(Song(song).to_json()))
+                                          for song in songs])
+
+                self._writer.execute("INSERT OR REPLACE INTO albums (album_id, signature) VALUES (?, ?)", (album["id"], self._album_signature(album)))
+
+    def _write_artists(self, artists: list[dict], removed_album_ids: set[str], last_modified: str) -> None:
+        ''' Replaces the stored artists, removes deleted albums and records the sync. Runs on a worker thread '''
+        with self._writer:
+            self._writer.execute("DELETE FROM items WHERE kind = 'artist'")
+            self._writer.executemany("INSERT INTO items (kind, item_id, name, json) VALUES ('artist', ?, ?, ?)",
+                                     [(artist["id"], artist.get("name", ""), json.dumps({field: artist[field] for field in ("id", "name", "coverArt", "albumCount") if field in artist}))
+                                      for artist in artists])
+
+            for album_id in removed_album_ids:
+                self._writer.execute("DELETE FROM items WHERE album_id = ?", (album_id,))
+                self._writer.execute("DELETE FROM albums WHERE album_id = ?", (album_id,))
+
+            self._writer.executemany("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                                     [("last_modified", last_modified), ("synced_at", str(time.time()))])
+
+    def close(self) -> None:
+        ''' Stops syncing and closes the database '''
+        if self._sync_task is not None:
+            self._sync_task.cancel()
+            self._sync_task = None
+
+        self._reader.close()
+        self._writer.close()
+
+
+def open_library(path: str="library.db") -> None:
+    ''' Opens the library index, starts syncing it in the background and lets `subsonic.search` answer from it '''
+    library = LibraryIndex(path)
+    library.start_sync(env.LIBRARY_SYNC_INTERVAL)
+    subsonic.local_library = library
+
+def close_library() -> None:
+    ''' Stops answering searches from the library index and closes it '''
+    if subsonic.local_library is not None:
+        subsonic.local_library.close()
+        subsonic.local_library = None
@@ -0,0 +1,194 @@
+''' Paced delivery of messages to channels, to stay within Discord's rate limits when the bot gets busy '''
+
+import asyncio
+import logging
+import random
+import time
+import discord
+
+from collections import deque
+from enum import IntEnum
+from typing import Awaitable, Callable
+
+logger = logging.getLogger(__name__)
+
+
+class Priority(IntEnum):
+    ''' How important it is that a message is delivered '''
+    LOW = 0
+    NORMAL = 1
+    HIGH = 2
+
+# Renders a message's embed and attachment when it is delivered. The argument is True if an existing message is being edited
+Renderer = Callable[[bool], Awaitable[tuple[discord.Embed, discord.File]]]
+
+class Outgoing():
+    ''' A message waiting to be delivered to a channel '''
+
+    __slots__ = ("render", "key", "priority", "on_sent", "created_at")
+
+    def __init__(self, render: Renderer, key: str=None, priority: Priority=Priority.NORMAL, on_sent: Callable[[discord.Message], None]=None) -> None:
+        self.render = render
+        self.key = key
+        self.priority = priority
+        self.on_sent = on_sent
+        self.created_at = time.monotonic()
+
+
+def backoff_delay(attempt: int) -> float:
+    ''' Returns how long to wait before retrying, growing with each attempt and jittered so retries don't arrive in lockstep '''
+    return min(0.5 * 2 ** attempt, 8) * random.uniform(0.5, 1.5)
+
+
+class ChannelOutbox():
+    ''' Delivers one channel's messages in order, paced to stay within the channel's rate limit
+
+    Notices sharing a key are coalesced: an unsent notice is replaced by a newer one, and a notice sent moments ago
+    is edited in place if nothing has been posted in the channel since.
+    Low priority messages are dropped if they have waited too long, or if too many messages are waiting.
+    '''
+
+    # Discord allows 5 messages per 5 seconds in each channel
+    BURST = 5
+    REFILL_INTERVAL = 1.0
+
+    MAX_PENDING = 10
+    STALE_AFTER = 30
+    COALESCE_WINDOW = 15
+    MAX_ATTEMPTS = 3
+
+    def __init__(self, messageable: discord.abc.Messageable) -> None:
+        self._messageable = messageable
+        self._pending: deque[Outgoing] = deque()
+        self._worker: asyncio.Task = None
+
+        self._tokens: float = self.BURST
+        self._refilled_at: float = time.monotonic()
+
+        # The last message sent, for coalescing notices into it: (key, message, time sent)
+        self._last_sent: tuple[str, discord.Message, float] = None
+
+    def post(self, outgoing: Outgoing) -> None:
+        ''' Queues a message for delivery '''
+
+        # A newer notice supersedes an unsent one with the same key
+        if outgoing.key is not None:
+            superseded = [item for item in self._pending if item.key == outgoing.key]
+            for item in superseded:
+                self._pending.remove(item)
+            stats["coalesced"] += len(superseded)
+
+        # Under pressure, make room by dropping the oldest low priority message. More important messages are never dropped
+        if len(self._pending) >= self.MAX_PENDING:
+            victim = next((item for item in self._pending if item.priority is Priority.LOW), None)
+            if victim is not None:
+                self._pending.remove(victim)
+                stats["dropped"] += 1
+            elif outgoing.priority is Priority.LOW:
+                stats["dropped"] += 1
+                return
+
+        self._pending.append(outgoing)
+
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.get_event_loop().create_task(self._run())
+
+    async def _run(self) -> None:
+        while self._pending:
+            outgoing = self._pending.popleft()
+
+            if outgoing.priority is Priority.LOW and time.monotonic() - outgoing.created_at > self.STALE_AFTER:
+                stats["dropped"] += 1
+                continue
+
+            await self._acquire()
+            await self._deliver(outgoing)
+
+    async def _acquire(self) -> None:
+        ''' Waits until the channel's rate limit allows another message '''
+        while True:
+            now = time.monotonic()
+            self._tokens = min(self.BURST, self._tokens + (now - self._refilled_at) / self.REFILL_INTERVAL)
+            self._refilled_at = now
+
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+
+            await asyncio.sleep((1 - self._tokens) * self.REFILL_INTERVAL)
+
+    def _coalesce_target(self, outgoing: Outgoing) -> discord.Message:
+        ''' Returns the message to edit instead of sending a new one, if any '''
+        if outgoing.key is None or self._last_sent is None:
+            return None
+
+        key, message, sent_at = self._last_sent
+        if key != outgoing.key or time.monotonic() - sent_at > self.COALESCE_WINDOW:
+            return None
+
+        # Only edit the message if it is still the latest in the channel, so the edit is seen
+        if getattr(self._messageable, "last_message_id", None) != message.id:
+            return None
+
+        return message
+
+    async def _deliver(self, outgoing: Outgoing) -> None:
+        target = self._coalesce_target(outgoing)
+
+        for attempt in range(self.MAX_ATTEMPTS):
+            try:
+                embed, file = await outgoing.render(target is not None)
+
+                if target is not None:
+                    attachments = [file] if file is not discord.utils.MISSING else []
+                    message = await target.edit(embed=embed, attachments=attachments)
+                    stats["edited"] += 1
+                else:
+                    message = await self._messageable.send(file=file, embed=embed, silent=True)
+                    stats["sent"] += 1
+
+                self._last_sent = (outgoing.key, message, time.monotonic())
+                if outgoing.on_sent is not None:
+                    outgoing.on_sent(message)
+                return
+            except discord.NotFound:
+                # The message being edited was deleted, so post a new one instead
+                target = None
+            except discord.HTTPException as err:
+                # Client errors other than rate limiting won't succeed on a retry
+                if err.status < 500 and err.status != 429:
+                    logger.error("Failed to deliver a message.", exc_info=err)
+                    stats["failed"] += 1
+                    return
+            except Exception as err:
+                # Anything else (e.g. a renderer or callback failing) is a bug in that message, so skip it rather than stopping the channel's worker
+                logger.error("Failed to deliver a message.", exc_info=err)
+                stats["failed"] += 1
+                return
+
+            logger.warning("Attempt %d at delivering a message failed...", attempt + 1)
+            await asyncio.sleep(backoff_delay(attempt))
+
+        stats["failed"] += 1
+
+
+# Counters describing outbound messages across all channels
+stats: dict[str, int] = {
+    "sent": 0,
+    "edited": 0,
+    "coalesced": 0,
+    "dropped": 0,
+    "failed": 0,
+}
+
+_outboxes: dict[int, ChannelOutbox] = {}
+
+def post(messageable: discord.abc.Messageable, outgoing: Outgoing) -> None:
+    ''' Queues a message for delivery to a channel '''
+    channel_id = getattr(messageable, "id", id(messageable))
+
+    outbox = _outboxes.get(channel_id)
+    if outbox is None:
+        outbox = _outboxes[channel_id] = ChannelOutbox(messageable)
+
+    outbox.post(outgoing)
@@ -0,0 +1,248 @@
+''' A long-lived audio pipeline that plays successive songs through a single FFmpeg process '''
+
+import array
+import asyncio
+import logging
+import queue
+import threading
+import aiohttp
+import discord
+
+from collections import deque
+from functools import lru_cache
+from typing import Awaitable, Callable
+
+import subsonic
+
+from subsonic import Song
+from util import env
+
+logger = logging.getLogger(__name__)
+
+
+class _Feed():
+    ''' A bounded, thread-safe stream of chunks, read by the thread that writes to FFmpeg's stdin '''
+
+    POLL_INTERVAL = 0.5
+
+    def __init__(self, max_chunks: int) -> None:
+        self._chunks: queue.Queue[bytes] = queue.Queue(max_chunks)
+        self._finished = threading.Event()
+        self._aborted = threading.Event()
+
+    def put(self, chunk: bytes) -> bool:
+        ''' Adds a chunk to the stream, blocking while it is full. Returns False if the stream was aborted '''
+        while not self._aborted.is_set():
+            try:
+                self._chunks.put(chunk, timeout=self.POLL_INTERVAL)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def read(self, _size: int=-1) -> bytes:
+        ''' Returns the next chunk, or an empty bytes object once the stream has ended '''
+        while not self._aborted.is_set():
+            try:
+                return self._chunks.get(timeout=self.POLL_INTERVAL)
+            except queue.Empty:
+                if self._finished.is_set():
+                    break
+        return b''
+
+    def finish(self) -> None:
+        ''' Ends the stream once the remaining chunks have been read '''
+        self._finished.set()
+
+    def abort(self) -> None:
+        ''' Ends the stream immediately, discarding the remaining chunks '''
+        self._aborted.set()
+
+
+class _FrameCounter():
+    ''' Measures the audio in an MP3 stream as it is fed in chunks, by walking its frame headers '''
+
+    # Layer III bitrates in kbps by bitrate index, for MPEG-1 and for MPEG-2/2.5
+    BITRATES = {
+        True: (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+        False: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+    }
+
+    # Sample rates by version bits: MPEG-2.5, reserved, MPEG-2, MPEG-1
+    SAMPLE_RATES = ((11025, 12000, 8000), None, (22050, 24000, 16000), (44100, 48000, 32000))
+
+    __slots__ = ("_buffer", "_skip", "seconds")
+
+    def __init__(self) -> None:
+        self._buffer = bytearray()
+        self._skip: int = 0
+        self.seconds: float = 0
+
+    def feed(self, chunk: bytes) -> None:
+        ''' Adds the duration of the frames starting in a chunk '''
+        buffer = self._buffer
+        buffer += chunk
+        pos = 0
+
+        while True:
+            skipped = min(self._skip, len(buffer) - pos)
+            pos += skipped
+            self._skip -= skipped
+            if self._skip > 0 or len(buffer) - pos < 10:
+                break
+
+            # Skip ID3v2 tags, whose size is stored as a syncsafe integer
+            if buffer[pos:pos + 3] == b"ID3":
+                size = (buffer[pos + 6] << 21) | (buffer[pos + 7] << 14) | (buffer[pos + 8] << 7) | buffer[pos + 9]
+                self._skip = 10 + size + (10 if buffer[pos + 5] & 0x10 else 0)
+                continue
+
+            frame = self._parse_header(buffer, pos)
+            if frame is None:
+                # Resynchronise on the next possible frame header
+                sync = buffer.find(b"\xff", pos + 1)
+                pos = sync if sync != -1 else len(buffer)
+                continue
+
+            length, seconds = frame
+            self.seconds += seconds
+            self._skip = length
+
+        del buffer[:pos]
+
+    @classmethod
+    def _parse_header(cls, buffer: bytearray, pos: int) -> tuple[int, float]:
+        ''' Returns the length in bytes and the duration of the Layer III frame starting at `pos`, or None if there isn't one '''
+        if buffer[pos] != 0xFF or buffer[pos + 1] & 0xE0 != 0xE0:
+            return None
+
+        version = (buffer[pos + 1] >> 3) & 3
+        layer = (buffer[pos + 1] >> 1) & 3
+        bitrate_index = buffer[pos + 2] >> 4
+        sample_rate_index = (buffer[pos + 2] >> 2) & 3
+        padding = (buffer[pos + 2] >> 1) & 1
+
+        if version == 1 or layer != 1 or bitrate_index in (0, 15) or sample_rate_index == 3:
+            return None
+
+        mpeg1 = version == 3
+        bitrate = cls.BITRATES[mpeg1][bitrate_index] * 1000
+        sample_rate = cls.SAMPLE_RATES[version][sample_rate_index]
+        samples = 1152 if mpeg1 else 576
+
+        return samples // 8 * bitrate // sample_rate + padding, samples / sample_rate
+
+
+@lru_cache(maxsize=16)
+def _gain_table(gain: float) -> tuple[int, ...]:
+    ''' Returns every 16-bit sample adjusted by a gain in dB and clipped, indexed by the sample's bits read as unsigned '''
+    factor = 10 ** (gain / 20)
+    return tuple([max(-32768, min(32767, round((sample - 65536 if sample >= 32768 else sample) * factor))) for sample in range(65536)])
+
+
+class ContinuousSource(discord.FFmpegPCMAudio):
+    ''' An audio source which plays songs back to back through one FFmpeg process, instead of one process per song
+
+    Songs are requested from the Subsonic server as MP3, which can be concatenated into a single stream,
+    and are fed to FFmpeg's stdin as they are needed. FFmpeg decodes the stream, and the voice client encodes it as one continuous Opus stream.
+    Each song's place in the stream is measured from the MP3 frames actually fed for it, so track changes land on the right packet,
+    and its replaygain adjustment is applied to its own packets.
+    '''
+
+    PACKETS_PER_SECOND = 50
+
+    CHUNK_SIZE = 16 * 1024
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, on_track_start: Callable[[Song], None]) -> None:
+        self._loop = loop
+        self._on_track_start = on_track_start
+        self._feed = _Feed(env.CONTINUOUS_BUFFER_CHUNKS)
+        self._feeder: asyncio.Task = None
+        self._pending: Song = None
+
+        # The packet at which each song fed to FFmpeg starts and its gain table, in order
+        self._track_starts: deque[tuple[int, Song, tuple[int, ...]]] = deque()
+        self._seconds_fed: float = 0
+        self._packets_read: int = 0
+
+        # Maps each sample of the song currently playing to its value with the song's gain applied, or None if it needs no adjusting
+        self._gain: tuple[int, ...] = None
+        self._started: bool = False
+
+        super().__init__(self._feed, pipe=True, before_options="-f mp3")
+
+    @property
+    def started(self) -> bool:
+        ''' Whether any song has started playing '''
+        return self._started
+
+    def start(self, next_song: Callable[[], Awaitable[Song]]) -> None:
+        ''' Begins feeding the songs returned by `next_song` to FFmpeg, until it returns None '''
+        self._feeder = self._loop.create_task(self._feed_songs(next_song))
+
+    async def _feed_songs(self, next_song: Callable[[], Awaitable[Song]]) -> None:
+        try:
+            while (song := await next_song()) is not None:
+                if not await self._feed_song(song):
+                    return
+        finally:
+            self._feed.finish()
+
+    async def _feed_song(self, song: Song) -> bool:
+        ''' Streams a song's audio into FFmpeg. Returns False if the pipeline has been stopped '''
+        stream_url = subsonic.stream(song.song_id, max_bitrate=env.SUBSONIC_MAX_BITRATE, stream_format="mp3")
+        frames = _FrameCounter()
+        self._pending = song
+
+        # Building a gain table takes a while, so do it here rather than on the audio thread when the song starts
+        gain = await asyncio.to_thread(_gain_table, song.track_gain) if song.track_gain else None
+
+        try:
+            async with subsonic.get_session().get(stream_url) as response:
+                response.raise_for_status()
+
+                async for chunk in response.content.iter_chunked(self.CHUNK_SIZE):
+                    # Only mark the start of the song once its audio actually arrives
+                    if self._pending is not None:
+                        self._track_starts.append((round(self._seconds_fed * self.PACKETS_PER_SECOND), song, gain))
+                        self._pending = None
+
+                    frames.feed(chunk)
+                    if not await asyncio.to_thread(self._feed.put, chunk):
+                        return False
+        except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+            logger.warning("Failed to stream song '%s' into the continuous pipeline.", song.song_id, exc_info=err)
+        finally:
+            # The next song starts where this one's audio actually ended, even if it was cut short
+            self._seconds_fed += frames.seconds
+
+        self._pending = None
+        return True
+
+    def unplayed_songs(self) -> list[Song]:
+        ''' Returns the songs taken from the queue which haven't started playing yet, in order '''
+        songs = [song for _, song, _ in self._track_starts]
+        if self._pending is not None:
+            songs.append(self._pending)
+        return songs
+
+    def read(self) -> bytes:
+        # Announce songs as their first packet is played, and switch to their gain
+        while self._track_starts and self._track_starts[0][0] <= self._packets_read:
+            _, song, self._gain = self._track_starts.popleft()
+            self._started = True
+            self._loop.call_soon_threadsafe(self._on_track_start, song)
+
+        self._packets_read += 1
+        packet = super().read()
+
+        # Packets are 16-bit PCM, so scale each sample by looking it up with its bits read as unsigned
+        if self._gain is not None and packet:
+            packet = array.array("h", map(self._gain.__getitem__, array.array("H", packet))).tobytes()
+        return packet
+
+    def cleanup(self) -> None:
+        self._feed.abort()
+        if self._feeder is not None:
+            self._loop.call_soon_threadsafe(self._feeder.cancel)
+        super().cleanup()
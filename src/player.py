@@ -1,115 +1,488 @@
 ''' A player object that handles playback and data for its respective guild '''
 
 import asyncio
+import logging
+import threading
 import discord
 
+from collections import deque
+from itertools import islice
+from typing import Iterable, Iterator
+
+import audiocache
+import autoplay
 import data
+import outbox
+import pipeline
+import readahead
 import subsonic
 import ui
 
 from subsonic import Song
+from util import env
+
+logger = logging.getLogger(__name__)
+
+# A change made to a queue: ("append", songs), ("prepend", songs), ("popleft", count) or ("clear", None)
+QueueChange = tuple[str, object]
+
+class SongQueue():
+    ''' A queue of songs, backed by a deque so that adding and removing songs at either end is O(1)
+
+    The total duration of the queue is kept up to date as songs are added and removed, so it never needs recounting.
+    Changes are also logged, so the stored copy of the queue can be updated without saving every song again.
+    '''
+
+    # Beyond this many unsaved changes, saving the whole queue again is simpler than replaying them
+    MAX_CHANGES = 1000
+
+    __slots__ = ("_songs", "_version", "_duration", "_changes", "_rewrite", "_lock")
+
+    def __init__(self, songs: Iterable[Song]=()) -> None:
+        self._songs: deque[Song] = deque(songs)
+        self._version: int = 0
+        self._duration: int = sum(song.duration for song in self._songs)
+
+        # Guards the songs and the change log, as changes are taken from the storage thread
+        self._changes: list[QueueChange] = []
+        self._rewrite: bool = False
+        self._lock = threading.Lock()
+
+    @property
+    def version(self) -> int:
+        ''' A counter which changes every time the queue is modified '''
+        return self._version
+
+    @property
+    def duration(self) -> int:
+        ''' The total duration of every song in the queue, in seconds '''
+        return self._duration
+
+    def snapshot(self) -> list[Song]:
+        ''' Returns a copy of the queue's songs. Safe to call from other threads '''
+        # Copying a deque happens in a single step under the GIL, so it can't observe a partial modification
+        return list(self._songs)
+
+    def take_changes(self) -> tuple[list[Song], list[QueueChange]]:
+        ''' Returns and forgets the changes made since the last call. If there were too many to log, returns every song in the queue instead. Safe to call from other threads '''
+        with self._lock:
+            if self._rewrite:
+                self._rewrite = False
+                self._changes = []
+                return list(self._songs), []
+
+            changes, self._changes = self._changes, []
+            return None, changes
+
+    def rewrite_on_next_save(self) -> None:
+        ''' Forgets the logged changes, so the next call to `take_changes` returns every song. Used when taken changes failed to save. Safe to call from other threads '''
+        with self._lock:
+            self._changes = []
+            self._rewrite = True
+
+    def _log(self, kind: str, value: object) -> None:
+        ''' Records a change. Consecutive changes of the same kind are merged. Must be called with the lock held '''
+        if self._rewrite:
+            return
+
+        last = self._changes[-1] if self._changes else None
+        if last is not None and last[0] == kind == "append":
+            last[1].extend(value)
+        elif last is not None and last[0] == kind == "popleft":
+            self._changes[-1] = (kind, last[1] + value)
+        elif kind == "clear":
+            self._changes = [(kind, value)]
+        elif len(self._changes) < self.MAX_CHANGES:
+            self._changes.append((kind, value))
+        else:
+            self._changes = []
+            self._rewrite = True
+
+    def page(self, start: int, count: int) -> list[Song]:
+        ''' Returns up to `count` songs starting at position `start`, without copying the rest of the queue '''
+        return list(islice(self._songs, start, start + count))
+
+    def append(self, song: Song) -> None:
+        ''' Adds a song to the back of the queue '''
+        with self._lock:
+            self._songs.append(song)
+            self._log("append", [song])
+        self._duration += song.duration
+        self._version += 1
+
+    def extend(self, songs: Iterable[Song]) -> None:
+        ''' Adds several songs to the back of the queue, in order '''
+        songs = list(songs)
+        with self._lock:
+            self._songs.extend(songs)
+            self._log("append", songs)
+        self._duration += sum(song.duration for song in songs)
+        self._version += 1
+
+    def popleft(self) -> Song:
+        ''' Removes and returns the song at the front of the queue '''
+        with self._lock:
+            song = self._songs.popleft()
+            self._log("popleft", 1)
+        self._duration -= song.duration
+        self._version += 1
+        return song
+
+    def peek(self) -> Song:
+        ''' Returns the song at the front of the queue without removing it, or None if the queue is empty '''
+        return self._songs[0] if self._songs else None
+
+    def prepend(self, songs: Iterable[Song]) -> None:
+        ''' Adds several songs to the front of the queue, keeping their order '''
+        songs = list(songs)
+        with self._lock:
+            self._songs.extendleft(reversed(songs))
+            self._log("prepend", songs)
+        self._duration += sum(song.duration for song in songs)
+        self._version += 1
+
+    def clear(self) -> None:
+        ''' Removes all songs from the queue '''
+        with self._lock:
+            self._songs.clear()
+            self._log("clear", None)
+        self._duration = 0
+        self._version += 1
+
+    def __len__(self) -> int:
+        return len(self._songs)
+
+    def __bool__(self) -> bool:
+        return len(self._songs) > 0
+
+    def __iter__(self) -> Iterator[Song]:
+        return iter(self._songs)
+
+    def __getitem__(self, index: int) -> Song:
+        return self._songs[index]
+
+class PreparedSource(discord.AudioSource):
+    ''' An audio source for an upcoming song, whose first packets have already been read so it can start instantly '''
+
+    def __init__(self, song: Song, source: discord.AudioSource) -> None:
+        self.song = song
+        self._source = source
+        self._buffered: deque[bytes] = deque()
+
+    def prebuffer(self, packet_count: int) -> None:
+        ''' Reads ahead the given number of packets from the underlying source. Blocks until they are available '''
+        for _ in range(packet_count):
+            packet = self._source.read()
+            if not packet:
+                break
+            self._buffered.append(packet)
+
+    def read(self) -> bytes:
+        if self._buffered:
+            return self._buffered.popleft()
+        return self._source.read()
 
-# Default player data
-_default_data: dict[str, any] = {
-    "current-song": None,
-    "current-position": 0,
-    "queue": [],
-}
+    def is_opus(self) -> bool:
+        return self._source.is_opus()
+
+    def cleanup(self) -> None:
+        self._buffered.clear()
+        self._source.cleanup()
 
 class Player():
     ''' Class that represents an audio player '''
+
+    __slots__ = ("_current_song", "_current_position", "_queue", "_prepared", "_prepare_task", "_autoplay")
+
     def __init__(self) -> None:
-        self._data = _default_data  
+        self._current_song: Song = None
+        self._current_position: int = 0
+        self._queue: SongQueue = SongQueue()
+        self._prepared: PreparedSource = None
+        self._prepare_task: asyncio.Task = None
+        self._autoplay: autoplay.CandidatePool = autoplay.CandidatePool()
 
     @property
     def current_song(self) -> Song:
         '''The current song'''
-        return self._data["current-song"]
+        return self._current_song
 
     @current_song.setter
     def current_song(self, song: Song) -> None:
-        self._data["current-song"] = song
+        self._current_song = song
+
+        # Remember played songs, so autoplay doesn't repeat them
+        if song is not None:
+            self._autoplay.played(song)
 
     @property
     def current_position(self) -> int:
         ''' The current position for the current song, in seconds. '''
-        return self._data["current-position"]
+        return self._current_position
 
     @current_position.setter
     def current_position(self, position: int) -> None:
         ''' Set the current position for the current song, in seconds. '''
-        self._data["current-position"] = position
+        self._current_position = position
 
     @property
-    def queue(self) -> list[Song]:
+    def queue(self) -> SongQueue:
         ''' The current audio queue. '''
-        return self._data["queue"]
+        return self._queue
 
     @queue.setter
-    def queue(self, value: list) -> None:
-        self._data["queue"] = value
+    def queue(self, value: Iterable[Song]) -> None:
+        self._queue = value if isinstance(value, SongQueue) else SongQueue(value)
+
+    def create_source(self, song: Song, position: int=0) -> discord.AudioSource:
+        ''' Creates an audio source streaming the given song from the cache, the local library or the Subsonic server. Returns None if no stream could be obtained '''
+
+        ffmpeg_options = {}
+
+        # Read the file directly if the library is mounted locally, falling back to the Subsonic server if it's missing
+        file_path = subsonic.local_path(song)
+        stream_url = None
+
+        if file_path is not None:
+            ffmpeg_options["bitrate"] = 128
+            ffmpeg_options["options"] = "-filter:a volume=replaygain=track"
+            gain = "replaygain-track"
+
+        # Otherwise build the stream URL for the provided song's ID (no request is sent until FFmpeg opens it)
+        elif env.SUBSONIC_OPUS_PASSTHROUGH:
+            # Have the server transcode to Opus, so FFmpeg only needs to repackage the packets for Discord
+            stream_url = subsonic.stream(song.song_id, max_bitrate=env.SUBSONIC_OPUS_BITRATE, stream_format="opus")
+            ffmpeg_options["bitrate"] = env.SUBSONIC_OPUS_BITRATE
+            gain = f"{song.track_gain or 0}dB"
+
+            # Applying replaygain requires re-encoding, so only do so when the song actually needs adjusting
+            if song.track_gain:
+                ffmpeg_options["options"] = f"-filter:a volume={song.track_gain}dB"
+            else:
+                ffmpeg_options["codec"] = "copy"
+        else:
+            stream_url = subsonic.stream(song.song_id, max_bitrate=env.SUBSONIC_MAX_BITRATE, stream_format=env.SUBSONIC_STREAM_FORMAT)
+            ffmpeg_options["bitrate"] = 128
+            ffmpeg_options["options"] = "-filter:a volume=replaygain=track"
+            gain = "replaygain-track"
+
+        # Play the song straight from disk if it has been encoded with the same settings before
+        cache_key = audiocache.cache_key(song, ffmpeg_options["bitrate"], gain)
+        if audiocache.lookup(cache_key) is not None:
+            try:
+                return audiocache.CachedOpusAudio(cache_key, position)
+            except OSError:
+                audiocache.opus_cache.remove(cache_key)
 
-    async def stream_track(self, interaction: discord.Interaction, song: Song, voice_client: discord.VoiceClient) -> None:
-        ''' Streams a track from the Subsonic server to a connected voice channel, and updates guild data accordingly '''
+        # Only record songs played from the start, so the cache always holds complete songs
+        record = position == 0 and env.AUDIO_CACHE_MAX_BYTES > 0
 
-        # Make sure the voice client is available
-        if voice_client is None:
-            await ui.ErrMsg.bot_not_in_voice_channel(interaction)
-            return
+        # Seek with FFmpeg, as servers ignore the stream's `timeOffset` unless they are transcoding
+        before_options = [f"-ss {position}"] if position > 0 else []
 
-        # Make sure the bot isn't already playing music
-        if voice_client.is_playing():
-            await ui.ErrMsg.already_playing(interaction)
-            return
+        # Download the stream ahead of FFmpeg, so stalls and dropped connections don't interrupt playback
+        source = file_path or stream_url
+        buffer = None
+        if stream_url is not None and env.READAHEAD_BYTES > 0:
+            buffer = readahead.ReadAheadBuffer(stream_url, env.READAHEAD_BYTES)
+            source = buffer
+            ffmpeg_options["pipe"] = True
+        elif stream_url is not None:
+            before_options.insert(0, "-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5")
 
-        # Get the stream from the Subsonic server, using the provided song's ID
-        ffmpeg_options = {"before_options": "-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5",
-                           "options": "-filter:a volume=replaygain=track"}
+        ffmpeg_options["before_options"] = " ".join(before_options) or None
 
         # Try three times to obtain the stream as an audio source
         # (This is a workaround for servers which intermittently return code 401)
         retry_count = 0
-        audio_src=None
         while retry_count < 3:
             try:
-                audio_src = discord.FFmpegOpusAudio(subsonic.stream(song.song_id), **ffmpeg_options)
-                break
-            except:
+                if record:
+                    audio_src = audiocache.RecordingOpusAudio(source, cache_key, duration=song.duration, **ffmpeg_options)
+                else:
+                    audio_src = discord.FFmpegOpusAudio(source, **ffmpeg_options)
+                return readahead.BufferedAudio(audio_src, buffer) if buffer is not None else audio_src
+            except discord.ClientException:
                 retry_count += 1
 
+        if buffer is not None:
+            buffer.close()
+        return None
+
+    async def stream_track(self, interaction: discord.Interaction, song: Song, voice_client: discord.VoiceClient, position: int=0, audio_src: discord.AudioSource=None) -> None:
+        ''' Streams a track from the Subsonic server to a connected voice channel, and updates guild data accordingly '''
+
+        # Make sure the voice client is available
+        if voice_client is None:
+            await ui.CmdErr.bot_not_in_voice_channel(interaction)
+            return
+
+        # Make sure the bot isn't already playing music
+        if voice_client.is_playing():
+            await ui.CmdErr.already_playing(interaction)
+            return
+
+        # Get the stream from the Subsonic server, unless it has been prepared in advance
+        if audio_src is None:
+            audio_src = self.create_source(song, position)
+
         if audio_src is None:
             try:
-                await ui.SysMsg.msg(interaction.channel, f"Skipping *{song.artist}* - **{song.title}**: Failed to obtain stream.")
+                await ui.SysMsg.msg(interaction.channel, f"Skipping *{song.artist}* - **{song.title}**: Failed to obtain stream.", priority=outbox.Priority.LOW)
             except:
                 pass
             await self.play_audio_queue(interaction, voice_client)
             return
 
-        # audio_src.read()
-
         # Update the currently playing song, and reset the duration
         self.current_song = song
-        self.current_position = 0
-
-        # Let the user know the track will play
-        try:
-            await ui.SysMsg.playing(interaction.channel, song)
-        except:
-            pass
-
-        # TODO: Start a duration timer
+        self.current_position = position
+        data.record_history(interaction.guild_id, song)
 
         # Begin playing the song
         loop = asyncio.get_event_loop()
 
         # TODO: probably should handle error
         def playback_finished(error):
-            print("playback_finished was called", flush=True)
-            # asyncio.run_coroutine_threadsafe(self.handle_autoplay(interaction, self.current_song.song_id), loop)
             asyncio.run_coroutine_threadsafe(self.play_audio_queue(interaction, voice_client), loop)
 
         voice_client.play(audio_src, after=playback_finished)
 
+        # Prepare the next song in the background, so it can start as soon as this one ends
+        self._prepare_task = loop.create_task(self.prepare_next(interaction, max(0, song.duration - position - env.PREFETCH_LEAD_SECONDS)))
+
+        # Let the user know the track is playing
+        await self.announce(interaction.channel, song)
+
+    async def stream_continuous(self, interaction: discord.Interaction, voice_client: discord.VoiceClient) -> None:
+        ''' Plays the queue through a single long-lived FFmpeg process, which is fed each song as the previous one finishes '''
+
+        loop = asyncio.get_event_loop()
+        last_fed: Song = None
+
+        async def next_song() -> Song:
+            nonlocal last_fed
+
+            # Songs are only taken from the queue once they are needed, so queue changes still apply until then
+            await self.handle_autoplay(interaction, last_fed.song_id if last_fed is not None else None)
+            last_fed = self.queue.popleft() if len(self.queue) != 0 else None
+            return last_fed
+
+        def track_started(song: Song) -> None:
+            self.current_song = song
+            self.current_position = 0
+            data.record_history(interaction.guild_id, song)
+            loop.create_task(self.announce(interaction.channel, song))
+
+        audio_src = pipeline.ContinuousSource(loop, track_started)
+
+        # Return songs the pipeline took from the queue but never played (e.g. when skipping), then carry on with the queue
+        async def pipeline_finished() -> None:
+            self.queue.prepend(audio_src.unplayed_songs())
+
+            # A pipeline which ended before playing anything would likely do so again, so play the next song on its own instead
+            if not audio_src.started and len(self.queue) != 0 and voice_client.is_connected():
+                song = self.queue.popleft()
+                self.current_song = song
+                await self.stream_track(interaction, song, voice_client)
+                return
+
+            await self.play_audio_queue(interaction, voice_client)
+
+        def playback_finished(error):
+            if error is not None:
+                logger.error("The continuous playback pipeline failed.", exc_info=error)
+            asyncio.run_coroutine_threadsafe(pipeline_finished(), loop)
+
+        voice_client.play(audio_src, after=playback_finished)
+        audio_src.start(next_song)
+
+    def seek(self, interaction: discord.Interaction, voice_client: discord.VoiceClient, position: int) -> bool:
+        ''' Restarts the current song from a position in seconds, without interrupting the queue. Returns False if the song couldn't be restarted '''
+
+        # Songs in the continuous pipeline share one FFmpeg process, so they can't be restarted individually
+        if self.current_song is None or env.CONTINUOUS_PLAYBACK:
+            return False
+
+        audio_src = self.create_source(self.current_song, position)
+        if audio_src is None:
+            return False
+
+        # Swap the source in place, so the player's callback still moves on to the next song when this one ends
+        previous_src = voice_client.source
+        voice_client.source = audio_src
+        previous_src.cleanup()
+
+        self.current_position = position
+
+        # The next song is now needed at a different time, so prepare it again
+        self.cancel_prepared()
+        self._prepare_task = asyncio.get_event_loop().create_task(self.prepare_next(interaction, max(0, self.current_song.duration - position - env.PREFETCH_LEAD_SECONDS)))
+
+        return True
+
+    async def announce(self, messageable: discord.abc.Messageable, song: Song) -> None:
+        ''' Lets the users know a song is playing '''
+        try:
+            await ui.SysMsg.playing(messageable, song)
+        except:
+            pass
+
+    async def prepare_next(self, interaction: discord.Interaction, delay: float) -> None:
+        ''' Prepares an audio source for the song at the front of the queue after the given delay, in seconds '''
+
+        await asyncio.sleep(delay)
+
+        # Preparing is only an optimisation, so a failure here just leaves the next song to start the usual way
+        try:
+            # Make sure there is a song to prepare, queueing one if autoplay is enabled
+            await self.handle_autoplay(interaction, self.current_song.song_id if self.current_song is not None else None)
+            song = self.queue.peek()
+            if song is None:
+                return
+
+            # Fetch the cover art in advance
+            await subsonic.get_album_art_file(song.cover_id)
+
+            audio_src = self.create_source(song)
+            if audio_src is None:
+                return
+
+            # Start FFmpeg and let it buffer the beginning of the song while the current one finishes
+            prepared = PreparedSource(song, audio_src)
+            try:
+                await asyncio.to_thread(prepared.prebuffer, env.PREFETCH_PACKETS)
+            except BaseException:
+                prepared.cleanup()
+                raise
+        except Exception as err:
+            logger.warning("Failed to prepare the next song.", exc_info=err)
+            return
+
+        self.cancel_prepared()
+        self._prepared = prepared
+
+    def take_prepared(self, song: Song) -> PreparedSource:
+        ''' Returns the source prepared for the given song, discarding any source prepared for a different song '''
+
+        prepared = self._prepared if self._prepared is not None and self._prepared.song is song else None
+        if prepared is not None:
+            self._prepared = None
+
+        self.cancel_prepared()
+        return prepared
+
+    def cancel_prepared(self) -> None:
+        ''' Stops preparing the next song, and releases any source prepared in advance '''
+
+        if self._prepare_task is not None and self._prepare_task is not asyncio.current_task():
+            self._prepare_task.cancel()
+        self._prepare_task = None
+
+        if self._prepared is not None:
+            self._prepared.cleanup()
+            self._prepared = None
+
 
     async def handle_autoplay(self, interaction: discord.Interaction, prev_song_id: str=None):
         ''' Handles populating the queue when autoplay is enabled '''
@@ -118,30 +491,21 @@ class Player():
         queue = data.guild_data(interaction.guild_id).player.queue
 
         # If queue is notempty or autoplay is disabled, don't handle autoplay
-        if queue != [] or autoplay_mode is data.AutoplayMode.NONE:
+        if len(queue) != 0 or autoplay_mode is data.AutoplayMode.NONE:
             return
 
-        # If there was no previous song provided, we default back to selecting a random song
-        if prev_song_id is None:
-            autoplay_mode = data.AutoplayMode.RANDOM
-
-        songs = []
-
-        match autoplay_mode:
-            case data.AutoplayMode.RANDOM:
-                songs = subsonic.get_random_songs(size=1)
-            case data.AutoplayMode.SIMILAR:
-                songs = subsonic.get_similar_songs(song_id=prev_song_id, count=1)
+        # Take the next song from the guild's pool of candidates, which is refilled in the background
+        song = await self._autoplay.take(autoplay_mode, prev_song_id)
 
         # If there's no match, throw an error
-        if len(songs) == 0:
+        if song is None:
             await ui.SysMsg.msg(interaction.channel, "Failed to obtain a song for autoplay.")
             return
         
-        self.queue.append(songs[0])
+        self.queue.append(song)
 
         # Fetch the cover art in advance
-        subsonic.get_album_art_file(songs[0].cover_id)
+        await subsonic.get_album_art_file(song.cover_id)
 
 
     async def play_audio_queue(self, interaction: discord.Interaction, voice_client: discord.VoiceClient) -> None:
@@ -149,26 +513,30 @@ class Player():
 
         # Check if the bot is connected to a voice channel; it's the caller's responsibility to open a voice channel
         if voice_client is None:
-            await ui.ErrMsg.bot_not_in_voice_channel(interaction)
+            await ui.CmdErr.bot_not_in_voice_channel(interaction)
             return
         
-        # Check if the bot is already playing something
-        if voice_client.is_playing():
-            print("not playing because player is already playing", flush=True)
+        # Check if the bot is already playing something, or has been disconnected since playback began
+        if voice_client.is_playing() or not voice_client.is_connected():
             return
 
         await self.handle_autoplay(interaction)
 
         # Check if the queue contains songs
-        if self.queue != []:
+        if len(self.queue) != 0 and env.CONTINUOUS_PLAYBACK:
+            await self.stream_continuous(interaction, voice_client)
+            return
+
+        if len(self.queue) != 0:
 
-            # Pop the first item from the queue and begin streaming it
-            song = self.queue.pop(0)
+            # Pop the first item from the queue and begin streaming it, using the source prepared for it if there is one
+            song = self.queue.popleft()
             self.current_song = song
 
-            await self.stream_track(interaction, song, voice_client)
+            await self.stream_track(interaction, song, voice_client, audio_src=self.take_prepared(song))
             return
             
 
         # If the queue is empty, playback has ended; we should let the user know
+        self.cancel_prepared()
         await ui.SysMsg.playback_ended(interaction.channel)
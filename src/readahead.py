@@ -0,0 +1,189 @@
+''' A read-ahead buffer between the Subsonic server and FFmpeg, to absorb stalls and disconnects from the server '''
+
+import asyncio
+import logging
+import threading
+import weakref
+import aiohttp
+import discord
+
+import subsonic
+
+from util import env
+
+logger = logging.getLogger(__name__)
+
+# All buffers currently streaming, for reporting their fill levels
+_active_buffers: "weakref.WeakSet[ReadAheadBuffer]" = weakref.WeakSet()
+
+
+class ReadAheadBuffer():
+    ''' A fixed-size ring buffer which downloads a stream in the background, ahead of FFmpeg reading it
+
+    The download runs on the event loop, while `read` is called from the thread feeding FFmpeg's stdin.
+    If the connection drops, the download resumes where it left off using an HTTP Range request.
+    A download which gives up ends the stream early, and is reported by `failed` so a truncated stream isn't mistaken for a complete one.
+    '''
+
+    CHUNK_SIZE = 16 * 1024
+
+    def __init__(self, url: str, capacity: int) -> None:
+        self._url = url
+        self._buffer = bytearray(capacity)
+        self._start: int = 0
+        self._size: int = 0
+        self._received: int = 0
+
+        self._condition = threading.Condition()
+        self._eof: bool = False
+        self._failed: bool = False
+        self._closed: bool = False
+        self.underruns: int = 0
+
+        self._loop = asyncio.get_event_loop()
+        self._space_available = asyncio.Event()
+        self._task = self._loop.create_task(self._download())
+
+        _active_buffers.add(self)
+
+    @property
+    def capacity(self) -> int:
+        ''' The size of the buffer, in bytes '''
+        return len(self._buffer)
+
+    @property
+    def failed(self) -> bool:
+        ''' Whether the download gave up before the end of the stream '''
+        return self._failed
+
+    @property
+    def fill_level(self) -> float:
+        ''' The fraction of the buffer currently holding unread data '''
+        return self._size / len(self._buffer)
+
+    def read(self, size: int=-1) -> bytes:
+        ''' Returns up to `size` bytes, blocking until data is available. Returns an empty bytes object at the end of the stream '''
+        with self._condition:
+            if self._size == 0 and not self._eof and not self._closed:
+                self.underruns += 1
+            while self._size == 0 and not self._eof and not self._closed:
+                self._condition.wait()
+
+            if self._size == 0 or self._closed:
+                return b''
+
+            size = self._size if size < 0 else min(size, self._size)
+            end = self._start + size
+            if end <= len(self._buffer):
+                data = bytes(self._buffer[self._start:end])
+            else:
+                data = bytes(self._buffer[self._start:]) + bytes(self._buffer[:end - len(self._buffer)])
+
+            self._start = end % len(self._buffer)
+            self._size -= size
+
+        self._loop.call_soon_threadsafe(self._space_available.set)
+        return data
+
+    def close(self) -> None:
+        ''' Stops downloading and discards the buffered data. Safe to call from any thread '''
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+        self._loop.call_soon_threadsafe(self._task.cancel)
+        _active_buffers.discard(self)
+
+    async def _write(self, data: memoryview) -> None:
+        ''' Copies data into the buffer, waiting for the reader whenever the buffer is full '''
+        while len(data) > 0 and not self._closed:
+            with self._condition:
+                free = len(self._buffer) - self._size
+                if free == 0:
+                    self._space_available.clear()
+                else:
+                    count = min(free, len(data))
+                    position = (self._start + self._size) % len(self._buffer)
+                    first = min(count, len(self._buffer) - position)
+
+                    self._buffer[position:position + first] = data[:first]
+                    self._buffer[:count - first] = data[first:count]
+                    self._size += count
+                    self._condition.notify_all()
+
+                    data = data[count:]
+                    continue
+
+            await self._space_available.wait()
+
+    async def _download(self) -> None:
+        attempt = 0
+
+        try:
+            while not self._closed:
+                # Resume from the last byte received if the connection was lost
+                headers = {"Range": f"bytes={self._received}-"} if self._received > 0 else {}
+
+                try:
+                    async with subsonic.get_session().get(self._url, headers=headers) as response:
+                        response.raise_for_status()
+
+                        # Servers which ignore the Range header resend the whole stream, so skip what was already received
+                        skip = self._received if response.status != 206 else 0
+
+                        async for chunk in response.content.iter_chunked(self.CHUNK_SIZE):
+                            data = memoryview(chunk)
+                            if skip > 0:
+                                skipped = min(skip, len(data))
+                                data = data[skipped:]
+                                skip -= skipped
+
+                            await self._write(data)
+                            self._received += len(data)
+                            attempt = 0
+                    return
+                except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+                    attempt += 1
+                    if attempt > env.READAHEAD_MAX_RETRIES:
+                        logger.error("Giving up on stream after %d attempts.", attempt, exc_info=err)
+                        self._failed = True
+                        return
+
+                    logger.warning("Stream interrupted after %d bytes, resuming (attempt %d).", self._received, attempt)
+                    await asyncio.sleep(min(2 ** attempt * 0.25, 5))
+        finally:
+            with self._condition:
+                self._eof = True
+                self._condition.notify_all()
+
+
+class BufferedAudio(discord.AudioSource):
+    ''' An audio source fed from a read-ahead buffer, which closes the buffer along with the source '''
+
+    def __init__(self, source: discord.AudioSource, buffer: ReadAheadBuffer) -> None:
+        self._source = source
+        self._buffer = buffer
+
+    def read(self) -> bytes:
+        return self._source.read()
+
+    def is_opus(self) -> bool:
+        return self._source.is_opus()
+
+    def cleanup(self) -> None:
+        self._buffer.close()
+        self._source.cleanup()
+
+
+def stats() -> dict[str, any]:
+    ''' Returns the fill levels of all active read-ahead buffers '''
+    buffers = list(_active_buffers)
+    fill_levels = [buffer.fill_level for buffer in buffers]
+
+    return {
+        "active": len(buffers),
+        "average_fill": round(sum(fill_levels) / len(fill_levels), 3) if fill_levels else 0,
+        "lowest_fill": round(min(fill_levels), 3) if fill_levels else 0,
+        "buffered_bytes": sum(buffer._size for buffer in buffers),
+        "underruns": sum(buffer.underruns for buffer in buffers),
+    }
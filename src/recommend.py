@@ -0,0 +1,129 @@
+''' Song recommendations learned from what each guild plays and skips '''
+
+import heapq
+import math
+
+from collections import Counter, deque
+from typing import Iterable
+
+from subsonic import Song
+from util import env
+
+
+class CooccurrenceIndex():
+    ''' A sparse, incrementally updated index of how closely songs are related, based on listening history
+
+    Songs played within a few plays of each other in the same guild are related, more strongly the closer together they were played.
+    Skipping a song weakens its relation to the songs played just before it.
+    Relations are normalised by how often each song is played, so popular songs don't dominate every recommendation.
+    Only the most recent history entries are kept; older entries are forgotten, along with the relations they made and the songs no entry refers to any more.
+    '''
+
+    SKIP_PENALTY = 2.0
+
+    # Relations which weaken to about nothing once their entries are forgotten are removed
+    EPSILON = 1e-9
+
+    __slots__ = ("_window", "_max_entries", "_entries", "_weights", "_play_counts", "_songs", "_references", "_recent")
+
+    def __init__(self, window: int, max_entries: int) -> None:
+        self._window = window
+        self._max_entries = max_entries
+        self._weights: dict[str, dict[str, float]] = {}
+        self._play_counts: Counter[str] = Counter()
+        self._songs: dict[str, Song] = {}
+
+        # The history entries the index is built from, oldest first: the song, whether it was skipped and the relations it changed
+        self._entries: deque[tuple[str, bool, list[tuple[str, float]]]] = deque()
+
+        # How many entries refer to each song
+        self._references: Counter[str] = Counter()
+
+        # The last few songs played in each guild, most recent last
+        self._recent: dict[int, deque[str]] = {}
+
+    def __len__(self) -> int:
+        return len(self._play_counts)
+
+    def remember(self, song: Song) -> None:
+        ''' Stores a song's details, so it can be recommended '''
+        self._songs[song.song_id] = song
+
+    def add(self, guild_id: int, song_id: str, skipped: bool=False) -> None:
+        ''' Updates the index with a song played (or skipped) in a guild '''
+        recent = self._recent.setdefault(guild_id, deque(maxlen=self._window))
+        links: list[tuple[str, float]] = []
+
+        if skipped:
+            # The skipped song no longer counts as context for the songs that follow it
+            if recent and recent[-1] == song_id:
+                recent.pop()
+
+            for distance, other_id in enumerate(reversed(recent), start=1):
+                links.append((other_id, -self.SKIP_PENALTY / distance))
+        else:
+            self._play_counts[song_id] += 1
+            for distance, other_id in enumerate(reversed(recent), start=1):
+                if other_id != song_id:
+                    links.append((other_id, 1 / distance))
+
+            recent.append(song_id)
+
+        for other_id, weight in links:
+            self._link(song_id, other_id, weight)
+
+        self._entries.append((song_id, skipped, links))
+        self._references[song_id] += 1
+
+        while len(self._entries) > self._max_entries:
+            self._forget(*self._entries.popleft())
+
+    def _forget(self, song_id: str, skipped: bool, links: list[tuple[str, float]]) -> None:
+        ''' Reverses a history entry's changes to the index, dropping the song's details once no entry refers to it '''
+        if not skipped:
+            self._play_counts[song_id] -= 1
+            if self._play_counts[song_id] <= 0:
+                del self._play_counts[song_id]
+
+        for other_id, weight in links:
+            self._link(song_id, other_id, -weight)
+
+        self._references[song_id] -= 1
+        if self._references[song_id] <= 0:
+            del self._references[song_id]
+            self._songs.pop(song_id, None)
+
+    def similar(self, seed_ids: list[str], count: int, exclude: Iterable[str]=()) -> list[Song]:
+        ''' Returns up to `count` songs most related to the seed songs, ranked best first. Later seeds are weighted more heavily '''
+        exclude = set(exclude)
+        scores: dict[str, float] = {}
+
+        for rank, seed_id in enumerate(reversed(seed_ids), start=1):
+            seed_plays = self._play_counts[seed_id] or 1
+
+            for other_id, weight in self._weights.get(seed_id, {}).items():
+                if weight <= 0 or other_id in exclude or other_id not in self._songs:
+                    continue
+
+                score = weight / (rank * math.sqrt(seed_plays * (self._play_counts[other_id] or 1)))
+                scores[other_id] = scores.get(other_id, 0) + score
+
+        best = heapq.nlargest(count, scores.items(), key=lambda item: item[1])
+        return [self._songs[song_id] for song_id, _ in best]
+
+    def _link(self, song_id: str, other_id: str, weight: float) -> None:
+        for first, second in ((song_id, other_id), (other_id, song_id)):
+            row = self._weights.setdefault(first, {})
+            total = row.get(second, 0) + weight
+
+            if abs(total) > self.EPSILON:
+                row[second] = total
+                continue
+
+            row.pop(second, None)
+            if len(row) == 0:
+                del self._weights[first]
+
+
+# Shared by all guilds, so each guild benefits from what the others listen to
+index = CooccurrenceIndex(env.RECOMMEND_WINDOW, env.RECOMMEND_HISTORY_LIMIT)
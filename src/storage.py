@@ -0,0 +1,204 @@
+''' Persistent storage for guild properties and queues, backed by SQLite '''
+
+import logging
+import sqlite3
+import threading
+import time
+
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+# A change to a guild's stored queue, with songs as json: ("append", songs), ("prepend", songs), ("popleft", count), ("clear", None) or ("replace", songs)
+QueueChange = tuple[str, object]
+
+# A guild's row: (guild id, autoplay mode, changes to apply to its stored queue, oldest first)
+GuildRow = tuple[int, int, list[QueueChange]]
+
+# An entry in a guild's listening history: (guild id, song id, whether the song was skipped)
+HistoryRow = tuple[int, str, bool]
+
+# Statements to apply for each schema version, in order. The database's `user_version` records the latest version applied
+SCHEMA_MIGRATIONS: list[list[str]] = [
+    # Version 1: one row per guild
+    [
+        '''CREATE TABLE guilds (
+            guild_id INTEGER PRIMARY KEY,
+            autoplay_mode INTEGER NOT NULL DEFAULT 0,
+            queue TEXT NOT NULL DEFAULT '[]'
+        )''',
+    ],
+    # Version 2: append-only listening history, and the songs it refers to
+    [
+        '''CREATE TABLE history (
+            guild_id INTEGER NOT NULL,
+            song_id TEXT NOT NULL,
+            skipped INTEGER NOT NULL DEFAULT 0,
+            played_at REAL NOT NULL
+        )''',
+        '''CREATE TABLE songs (
+            song_id TEXT PRIMARY KEY,
+            song TEXT NOT NULL
+        )''',
+    ],
+    # Version 3: one row per queued song, so queues can be updated without rewriting them in full
+    [
+        '''CREATE TABLE queue_entries (
+            guild_id INTEGER NOT NULL,
+            position INTEGER NOT NULL,
+            song TEXT NOT NULL,
+            PRIMARY KEY (guild_id, position)
+        ) WITHOUT ROWID''',
+        '''INSERT INTO queue_entries (guild_id, position, song)
+           SELECT guilds.guild_id, CAST(entry.key AS INTEGER), entry.value FROM guilds, json_each(guilds.queue) AS entry''',
+        "ALTER TABLE guilds DROP COLUMN queue",
+    ],
+]
+
+class GuildStore():
+    ''' Stores one row per guild, each guild's queue and listening history, and writes changes back in batches from a background thread
+
+    Queued songs are stored one row each, ordered by position. Songs are added below the lowest position or above the highest,
+    so updating a queue only touches the songs that were added or removed.
+    '''
+    def __init__(self, path: str) -> None:
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread: threading.Thread = None
+
+        # History entries waiting to be appended by the background writer, with the json of the songs they refer to
+        self._pending_history: list[tuple[int, str, bool, float]] = []
+        self._pending_songs: dict[str, str] = {}
+        self._history_lock = threading.Lock()
+
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._migrate()
+
+    def _migrate(self) -> None:
+        ''' Brings the database schema up to date '''
+        version = self._conn.execute("PRAGMA user_version").fetchone()[0]
+
+        for target, statements in enumerate(SCHEMA_MIGRATIONS[version:], start=version + 1):
+            with self._conn:
+                for statement in statements:
+                    self._conn.execute(statement)
+                self._conn.execute(f"PRAGMA user_version = {target}")
+            logger.info("Migrated guild storage to schema version %d.", target)
+
+    def load(self, guild_id: int) -> tuple[int, list[str]]:
+        ''' Returns the autoplay mode and the json of each queued song stored for a guild, or None if nothing is stored '''
+        with self._lock:
+            row = self._conn.execute("SELECT autoplay_mode FROM guilds WHERE guild_id = ?", (guild_id,)).fetchone()
+            if row is None:
+                return None
+
+            queue = [song for (song,) in self._conn.execute("SELECT song FROM queue_entries WHERE guild_id = ? ORDER BY position", (guild_id,))]
+            return row[0], queue
+
+    def save(self, rows: list[GuildRow]) -> None:
+        ''' Writes a batch of guild rows in a single transaction '''
+        if len(rows) == 0:
+            return
+
+        with self._lock, self._conn:
+            self._conn.executemany(
+                '''INSERT INTO guilds (guild_id, autoplay_mode) VALUES (?, ?)
+                   ON CONFLICT (guild_id) DO UPDATE SET autoplay_mode = excluded.autoplay_mode''',
+                [(guild_id, autoplay_mode) for guild_id, autoplay_mode, _ in rows])
+
+            for guild_id, _, changes in rows:
+                for kind, value in changes:
+                    self._apply_queue_change(guild_id, kind, value)
+
+        logger.debug("Saved %d guild rows.", len(rows))
+
+    def _apply_queue_change(self, guild_id: int, kind: str, value: object) -> None:
+        ''' Applies one change to a guild's stored queue. Must be called within a transaction '''
+        match kind:
+            case "append":
+                start = self._conn.execute("SELECT COALESCE(MAX(position) + 1, 0) FROM queue_entries WHERE guild_id = ?", (guild_id,)).fetchone()[0]
+                self._conn.executemany("INSERT INTO queue_entries (guild_id, position, song) VALUES (?, ?, ?)",
+                                       [(guild_id, start + i, song) for i, song in enumerate(value)])
+            case "prepend":
+                start = self._conn.execute("SELECT COALESCE(MIN(position), 0) FROM queue_entries WHERE guild_id = ?", (guild_id,)).fetchone()[0] - len(value)
+                self._conn.executemany("INSERT INTO queue_entries (guild_id, position, song) VALUES (?, ?, ?)",
+                                       [(guild_id, start + i, song) for i, song in enumerate(value)])
+            case "popleft":
+                self._conn.execute(
+                    '''DELETE FROM queue_entries WHERE guild_id = ? AND position IN (
+                           SELECT position FROM queue_entries WHERE guild_id = ? ORDER BY position LIMIT ?
+                       )''', (guild_id, guild_id, value))
+            case "clear" | "replace":
+                self._conn.execute("DELETE FROM queue_entries WHERE guild_id = ?", (guild_id,))
+                if kind == "replace":
+                    self._conn.executemany("INSERT INTO queue_entries (guild_id, position, song) VALUES (?, ?, ?)",
+                                           [(guild_id, i, song) for i, song in enumerate(value)])
+
+    def load_history(self, limit: int) -> list[HistoryRow]:
+        ''' Returns up to `limit` of the most recent history entries across all guilds, oldest first '''
+        with self._lock:
+            rows = self._conn.execute(
+                '''SELECT guild_id, song_id, skipped FROM (
+                       SELECT rowid, guild_id, song_id, skipped FROM history ORDER BY rowid DESC LIMIT ?
+                   ) ORDER BY rowid''', (limit,)).fetchall()
+
+        return [(guild_id, song_id, bool(skipped)) for guild_id, song_id, skipped in rows]
+
+    def load_songs(self, limit: int) -> list[str]:
+        ''' Returns the json of every song referred to by the `limit` most recent history entries '''
+        with self._lock:
+            rows = self._conn.execute(
+                '''SELECT song FROM songs WHERE song_id IN (
+                       SELECT song_id FROM history ORDER BY rowid DESC LIMIT ?
+                   )''', (limit,))
+            return [row[0] for row in rows]
+
+    def record_history(self, guild_id: int, song_id: str, skipped: bool, song_json: str) -> None:
+        ''' Queues a played or skipped song to be appended to the history by the background writer '''
+        with self._history_lock:
+            self._pending_history.append((guild_id, song_id, skipped, time.time()))
+            self._pending_songs[song_id] = song_json
+
+    def start_write_behind(self, collect_dirty: Callable[[], list[GuildRow]], save_failed: Callable[[list[GuildRow]], None], interval: float) -> None:
+        ''' Starts a background thread which periodically saves the rows returned by `collect_dirty`, handing any it fails to save to `save_failed` '''
+        def write_behind() -> None:
+            while not self._stop_event.wait(interval):
+                self._flush(collect_dirty, save_failed)
+            self._flush(collect_dirty, save_failed)
+
+        self._thread = threading.Thread(target=write_behind, name="guild-store-writer", daemon=True)
+        self._thread.start()
+
+    def close(self) -> None:
+        ''' Stops the background writer after a final flush, and closes the database '''
+        if self._thread is not None:
+            self._stop_event.set()
+            self._thread.join()
+            self._thread = None
+
+        with self._lock:
+            self._conn.close()
+
+    def _flush(self, collect_dirty: Callable[[], list[GuildRow]], save_failed: Callable[[list[GuildRow]], None]) -> None:
+        rows = collect_dirty()
+        try:
+            self.save(rows)
+        except sqlite3.Error as err:
+            logger.error("Failed to save guild rows.", exc_info=err)
+            save_failed(rows)
+
+        with self._history_lock:
+            history, self._pending_history = self._pending_history, []
+            songs, self._pending_songs = self._pending_songs, {}
+
+        if len(history) == 0:
+            return
+
+        try:
+            with self._lock, self._conn:
+                self._conn.executemany("INSERT INTO history (guild_id, song_id, skipped, played_at) VALUES (?, ?, ?, ?)", history)
+                self._conn.executemany("INSERT OR REPLACE INTO songs (song_id, song) VALUES (?, ?)", songs.items())
+        except sqlite3.Error as err:
+            logger.error("Failed to append %d history entries.", len(history), exc_info=err)
@@ -8,7 +8,11 @@ import discord
 
 from discord.ext import commands
 
+import audiocache
+import background
 import data
+import library
+import subsonic
 
 from util import env
 from util import logs
@@ -54,6 +58,9 @@ class SubmeisterClient(commands.Bot):
 
         await self.load_extensions()
 
+        if env.LIBRARY_INDEX:
+            library.open_library()
+
         if self.test_guild:
             await self.sync_command_tree()
 
@@ -62,16 +69,25 @@ class SubmeisterClient(commands.Bot):
 
         self.logger.info("Logged as: %s | Connected Guilds: %s | Loaded Extensions: %s", self.user, len(self.guilds), list(self.extensions))
 
+    async def close(self) -> None:
+        ''' Closes the connection to Discord and the library index, cancels background command handlers, releases pooled connections to the Subsonic server and saves cache indexes. '''
+
+        await super().close()
+        background.cancel_all()
+        library.close_library()
+        await subsonic.close()
+        audiocache.opus_cache.flush()
+
 def exit_handler():
     ''' Function ran on application exit. '''
 
-    data.save_guild_properties_to_disk()
+    data.close_guild_storage()
 
 def run():
     logs.setup_logging()
     logger = logging.getLogger(__name__)
 
-    data.load_guild_properties_from_disk()
+    data.open_guild_storage()
     atexit.register(exit_handler)
 
     client = SubmeisterClient(logger, test_guild=env.DISCORD_TEST_GUILD)
@@ -1,33 +1,56 @@
 ''' For interfacing with the Subsonic API '''
 
+import asyncio
+import hashlib
 import logging
 import os
-import requests
+import secrets
+import sys
+import time
+import weakref
+import aiohttp
 
-from pathlib import Path
+from collections import OrderedDict
+
+from urllib.parse import urlencode
 
 from util import env
+from util.diskcache import DiskCache
 
 from typing import Union
 
 logger = logging.getLogger(__name__)
 
 
-# Parameters for the Subsonic API
+# Parameters for the Subsonic API (credentials are added by `request_params`)
 SUBSONIC_REQUEST_PARAMS = {
         "u": env.SUBSONIC_USER,
-        "p": env.SUBSONIC_PASSWORD,
         "v": "1.15.0",
         "c": "submeister",
         "f": "json"
     }
 
+def request_params() -> dict[str, str]:
+    ''' Returns the common parameters for a Subsonic API request, including authentication '''
+
+    # Send the password in plain text unless salted token authentication is enabled
+    if not env.SUBSONIC_TOKEN_AUTH:
+        return SUBSONIC_REQUEST_PARAMS | {"p": env.SUBSONIC_PASSWORD}
+
+    # Use a fresh salt for every request, as recommended by the API
+    salt = secrets.token_hex(8)
+    token = hashlib.md5((env.SUBSONIC_PASSWORD + salt).encode("utf-8")).hexdigest()
+    return SUBSONIC_REQUEST_PARAMS | {"t": token, "s": salt}
+
 class Album():
     ''' Object representing an album returned from the Subsonic API '''
+
+    __slots__ = ("_id", "_name", "_artist", "_cover_id", "_song_count", "_duration")
+
     def __init__(self, json_object: dict) -> None:
         self._id: str = json_object["id"] if "id" in json_object else ""
         self._name: str = json_object["name"] if "name" in json_object else "Unknown Album"
-        self._artist: str = json_object["artist"] if "artist" in json_object else "Unknown Artist"
+        self._artist: str = sys.intern(json_object["artist"]) if "artist" in json_object else "Unknown Artist"
         self._cover_id: str = json_object["coverArt"] if "coverArt" in json_object else ""
         self._song_count: int = json_object["songCount"] if "songCount" in json_object else 0
         self._duration: int = json_object["duration"] if "duration" in json_object else 0
@@ -68,6 +91,9 @@ class Album():
 
 class Artist():
     ''' Object representing an album returned from the Subsonic API '''
+
+    __slots__ = ("_id", "_name", "_cover_id", "_album_count")
+
     def __init__(self, json_object: dict) -> None:
         self._id: str = json_object["id"] if "id" in json_object else ""
         self._name: str = json_object["name"] if "name" in json_object else "Unknown Artist"
@@ -95,15 +121,54 @@ class Artist():
         return self._album_count
 
 class Song():
-    ''' Object representing a song returned from the Subsonic API '''
+    ''' Object representing a song returned from the Subsonic API
+
+    Songs should be created with `Song.from_json`, which interns them so that each track is a single object process-wide.
+    Queues and caches can then hold references to the shared object instead of their own copies.
+    '''
+
+    __slots__ = ("_id", "_title", "_album", "_artist", "_cover_id", "_duration", "_track_gain", "_path", "__weakref__")
+
+    # Pool of all live songs, keyed by song id
+    _pool: "weakref.WeakValueDictionary[str, Song]" = weakref.WeakValueDictionary()
+
     def __init__(self, json_object: dict) -> None:
         #! Other properties exist in the initial json response but are currently unused by Submeister and thus aren't supported here
         self._id: str = json_object["id"] if "id" in json_object else ""
         self._title: str = json_object["title"] if "title" in json_object else "Unknown Track"
-        self._album: str = json_object["album"] if "album" in json_object else "Unknown Album"
-        self._artist: str = json_object["artist"] if "artist" in json_object else "Unknown Artist"
-        self._cover_id: str = json_object["coverArt"] if "coverArt" in json_object else ""
+        self._album: str = sys.intern(json_object["album"]) if "album" in json_object else "Unknown Album"
+        self._artist: str = sys.intern(json_object["artist"]) if "artist" in json_object else "Unknown Artist"
+        self._cover_id: str = sys.intern(json_object["coverArt"]) if "coverArt" in json_object else ""
         self._duration: int = json_object["duration"] if "duration" in json_object else 0
+        self._track_gain: float = json_object["replayGain"].get("trackGain") if "replayGain" in json_object else None
+        self._path: str = json_object["path"] if "path" in json_object else ""
+
+    @classmethod
+    def from_json(cls, json_object: dict) -> "Song":
+        ''' Returns the pooled song for a json object returned by the Subsonic API, creating it if it isn't pooled yet '''
+        song_id = json_object.get("id")
+        song = cls._pool.get(song_id) if song_id else None
+
+        if song is None:
+            song = cls(json_object)
+            if song_id:
+                cls._pool[song_id] = song
+
+        return song
+
+    @classmethod
+    def pool_size(cls) -> int:
+        ''' The number of distinct songs currently alive '''
+        return len(cls._pool)
+
+    def __setstate__(self, state: any) -> None:
+        # Songs pickled by older versions of Submeister store their attributes in a dict instead of slots
+        self._track_gain = None
+        self._path = ""
+        if isinstance(state, tuple):
+            state = state[1]
+        for name, value in state.items():
+            setattr(self, name, value)
 
     @property
     def song_id(self) -> str:
@@ -140,18 +205,128 @@ class Song():
         ''' The total duration of the song as a human readable string in the format `mm:ss` '''
         return f"{(self._duration // 60):02d}:{(self._duration % 60):02d}"
 
+    @property
+    def track_gain(self) -> float:
+        ''' The replaygain adjustment for the song in dB, if the server provides one (OpenSubsonic extension) '''
+        return self._track_gain
 
-def check_subsonic_error(response: requests.Response) -> bool:
+    @property
+    def path(self) -> str:
+        ''' The path of the song's file on the Subsonic server, if the server provides one '''
+        return self._path
+
+    def to_json(self) -> dict:
+        ''' Returns the song as a json object in the format used by the Subsonic API '''
+        json_object = {
+            "id": self._id,
+            "title": self._title,
+            "album": self._album,
+            "artist": self._artist,
+            "coverArt": self._cover_id,
+            "duration": self._duration,
+        }
+
+        if self._track_gain is not None:
+            json_object["replayGain"] = {"trackGain": self._track_gain}
+
+        if self._path:
+            json_object["path"] = self._path
+
+        return json_object
+
+
+class ResponseCache():
+    ''' A bounded cache of parsed Subsonic API responses, with per-endpoint expiry and LRU eviction '''
+    def __init__(self, ttls: dict[str, float], max_items: int) -> None:
+        self._ttls = ttls
+        self._max_items = max_items
+        self._entries: OrderedDict[tuple, tuple[float, list]] = OrderedDict()
+        self._item_count: int = 0
+
+        self.hits: int = 0
+        self.misses: int = 0
+        self.evictions: int = 0
+
+    @staticmethod
+    def _key(endpoint: str, params: dict[str, any]) -> tuple:
+        return (endpoint, tuple(sorted(params.items())))
+
+    def get(self, endpoint: str, params: dict[str, any]) -> list:
+        ''' Returns a copy of the cached results for a request, or None if nothing valid is cached '''
+        key = self._key(endpoint, params)
+        entry = self._entries.get(key)
+
+        if entry is None:
+            self.misses += 1
+            return None
+
+        expires_at, results = entry
+        if expires_at < time.monotonic():
+            self._remove(key)
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return list(results)
+
+    def put(self, endpoint: str, params: dict[str, any], results: list) -> None:
+        ''' Stores the results of a request, evicting the least recently used entries if over capacity '''
+        ttl = self._ttls.get(endpoint, 0)
+        if ttl <= 0 or len(results) > self._max_items:
+            return
+
+        key = self._key(endpoint, params)
+        if key in self._entries:
+            self._remove(key)
+
+        self._entries[key] = (time.monotonic() + ttl, list(results))
+        self._item_count += len(results) + 1
+
+        while self._item_count > self._max_items:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def invalidate(self, endpoint: str=None) -> None:
+        ''' Drops all cached entries, or only those for the given endpoint '''
+        for key in [key for key in self._entries if endpoint is None or key[0] == endpoint]:
+            self._remove(key)
+
+    def stats(self) -> dict[str, int]:
+        ''' Returns counters describing the cache's usage '''
+        return {
+            "entries": len(self._entries),
+            "items": self._item_count,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    def _remove(self, key: tuple) -> None:
+        _, results = self._entries.pop(key)
+        self._item_count -= len(results) + 1
+
+# Time to live (in seconds) of cached responses, per endpoint. Endpoints not listed here are never cached
+RESPONSE_CACHE_TTLS: dict[str, float] = {
+    "search3": 60,
+    "getAlbum": 600,
+    "getArtist": 600,
+}
+
+response_cache = ResponseCache(RESPONSE_CACHE_TTLS, env.SUBSONIC_CACHE_MAX_ITEMS)
+
+# Cover art stored on disk, keyed by cover id and size
+art_cache = DiskCache("cache/art", env.ART_CACHE_MAX_BYTES, ".jpg")
+
+# Local mirror of the library used to answer searches, set by `library.open_library` when enabled
+local_library = None
+
+def check_subsonic_error(json: dict) -> bool:
     ''' Checks and logs error codes returned by the subsonic API. Returns True if an error is present. '''
 
-    try:
-        json = response.json()
-    except requests.exceptions.JSONDecodeError:
-        return False
-
     try:
         err_code: int = json["subsonic-response"]["error"]["code"]
-    except KeyError:
+    except (KeyError, TypeError):
         return False
 
     match err_code:
@@ -179,14 +354,44 @@ def check_subsonic_error(response: requests.Response) -> bool:
     logger.warning("Subsonic API request responded with error code %s: %s", err_code, err_msg)
     return True
 
-def search(query: str, *, artist_count: int=20, artist_offset: int=0, album_count: int=20, album_offset: int=0, song_count: int=20, song_offset: int=0) -> list[Union[Song, Album, Artist]]:
-    ''' Send a search request to the subsonic API '''
+# Connection pool shared by all requests to the Subsonic server
+_session: aiohttp.ClientSession = None
+
+def get_session() -> aiohttp.ClientSession:
+    ''' Returns the pooled HTTP session used for Subsonic traffic, creating it if needed '''
+    global _session
+
+    # The session must be created from within the running event loop, so it is created lazily
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(limit=0, limit_per_host=env.SUBSONIC_MAX_CONNECTIONS, keepalive_timeout=env.SUBSONIC_KEEPALIVE_TIMEOUT)
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=env.SUBSONIC_CONNECT_TIMEOUT, sock_read=env.SUBSONIC_READ_TIMEOUT)
+        _session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+    return _session
+
+async def close() -> None:
+    ''' Closes the pooled HTTP session and flushes on-disk caches '''
+    global _session
+
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
 
-    # Sanitize special characters in the user's query
-    #parsed_query = urlParse.quote(query, safe='')
+    art_cache.flush()
+
+async def _request_json(endpoint: str, params: dict[str, any]) -> dict:
+    ''' Sends a GET request to the given endpoint of the subsonic API and returns the decoded json response '''
+
+    params = request_params() | params
+
+    async with get_session().get(f"{env.SUBSONIC_SERVER}/rest/{endpoint}", params=params) as response:
+        return await response.json(content_type=None)
+
+async def search(query: str, *, artist_count: int=20, artist_offset: int=0, album_count: int=20, album_offset: int=0, song_count: int=20, song_offset: int=0) -> list[Union[Song, Album, Artist]]:
+    ''' Searches the library, using the local library index if it is available and the subsonic API otherwise '''
 
     search_params = {
-        "query": query, #todo: fix parsed query
+        "query": query,
         "artistCount": str(artist_count),
         "artistOffset": str(artist_offset),
         "albumCount": str(album_count),
@@ -195,10 +400,24 @@ def search(query: str, *, artist_count: int=20, artist_offset: int=0, album_coun
         "songOffset": str(song_offset)
     }
 
-    params = SUBSONIC_REQUEST_PARAMS | search_params
+    # Answer from the local library index once it has been synced, only asking the server if the index has no matches for the query at all
+    if local_library is not None and local_library.ready:
+        results = local_library.search(query, artist_count=artist_count, artist_offset=artist_offset, album_count=album_count,
+                                       album_offset=album_offset, song_count=song_count, song_offset=song_offset)
+        if len(results) > 0 or not env.LIBRARY_SERVER_FALLBACK:
+            return results
+
+        # An empty page past the first is just the end of the results, unless the first page is empty too
+        if artist_offset > 0 or album_offset > 0 or song_offset > 0:
+            first_page = local_library.search(query, artist_count=min(artist_count, 1), album_count=min(album_count, 1), song_count=min(song_count, 1))
+            if len(first_page) > 0:
+                return results
+
+    cached = response_cache.get("search3", search_params)
+    if cached is not None:
+        return cached
 
-    response = requests.get(f"{env.SUBSONIC_SERVER}/rest/search3.view", params=params, timeout=20)
-    search_data = response.json()
+    search_data = await _request_json("search3.view", search_params)
 
     results : list[Union[Song, Album, Artist]]= []
 
@@ -208,38 +427,68 @@ def search(query: str, *, artist_count: int=20, artist_offset: int=0, album_coun
         for item in search_data["subsonic-response"]["searchResult3"]["album"] if "album" in search_data["subsonic-response"]["searchResult3"] else []:
             results.append(Album(item))
         for item in search_data["subsonic-response"]["searchResult3"]["song"] if "song" in search_data["subsonic-response"]["searchResult3"] else []:
-            results.append(Song(item))
+            results.append(Song.from_json(item))
     except KeyError:
         return []
 
+    response_cache.put("search3", search_params, results)
     return results
 
-def get_album_art_file(cover_id: str, size: int=300) -> str:
+async def get_album_art_file(cover_id: str, size: int=300) -> str:
     ''' Request album art from the subsonic API '''
-    target_path = f"cache/{cover_id}.jpg"
+    cache_key = f"{cover_id}:{size}"
+    cached = art_cache.lookup(cache_key)
 
-    # Check if the cover art is already cached (TODO: Check for last-modified date?)
-    if os.path.exists(target_path):
-        return target_path
+    # Use the cached cover art as-is until it is due for revalidation
+    if cached is not None and time.time() - cached["validated"] < env.ART_CACHE_REVALIDATE_AFTER:
+        return art_cache.path(cache_key)
 
     cover_params = {
         "id": cover_id,
         "size": str(size)
     }
 
-    params = SUBSONIC_REQUEST_PARAMS | cover_params
-    response = requests.get(f"{env.SUBSONIC_SERVER}/rest/getCoverArt", params=params, timeout=20)
+    params = request_params() | cover_params
 
-    # Grab cover art for the current song
-    if check_subsonic_error(response):
+    # Make the request conditional if the cover art is already cached
+    headers = {}
+    if cached is not None and cached["etag"] is not None:
+        headers["If-None-Match"] = cached["etag"]
+    if cached is not None and cached["last_modified"] is not None:
+        headers["If-Modified-Since"] = cached["last_modified"]
+
+    try:
+        async with get_session().get(f"{env.SUBSONIC_SERVER}/rest/getCoverArt", params=params, headers=headers) as response:
+            if response.status == 304 and cached is not None:
+                art_cache.update_meta(cache_key, {"validated": time.time()})
+                return art_cache.path(cache_key)
+
+            # Only a complete image may replace the cached one; on any other status, keep using what is cached
+            if response.status != 200:
+                logger.warning("Failed to fetch cover art '%s': the server responded with status %d.", cover_id, response.status)
+                return art_cache.path(cache_key) if cached is not None else "resources/cover_not_found.jpg"
+
+            content = await response.read()
+
+            # The API responds with json instead of image data when an error occurs
+            if response.content_type in ("application/json", "text/xml") and check_subsonic_error(await response.json(content_type=None)):
+                return "resources/cover_not_found.jpg"
+
+            meta = {
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+                "validated": time.time()
+            }
+    except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+        # Keep using a stale cover over showing none at all
+        if cached is not None:
+            return art_cache.path(cache_key)
+        logger.warning("Failed to fetch cover art '%s'.", cover_id, exc_info=err)
         return "resources/cover_not_found.jpg"
 
-    file = Path(target_path)
-    file.parent.mkdir(exist_ok=True, parents=True)
-    file.write_bytes(response.content)
-    return target_path
+    return await asyncio.to_thread(art_cache.write, cache_key, content, meta)
 
-def get_random_songs(size: int=None, genre: str=None, from_year: int=None, to_year: int=None, music_folder_id: str=None) -> list[Song]:
+async def get_random_songs(size: int=None, genre: str=None, from_year: int=None, to_year: int=None, music_folder_id: str=None) -> list[Song]:
     ''' Request random songs from the subsonic API '''
 
     search_params: dict[str, any] = {}
@@ -260,18 +509,15 @@ def get_random_songs(size: int=None, genre: str=None, from_year: int=None, to_ye
     if music_folder_id is not None:
         search_params["musicFolderId"] = music_folder_id
 
-
-    params = SUBSONIC_REQUEST_PARAMS | search_params
-    response = requests.get(f"{env.SUBSONIC_SERVER}/rest/getRandomSongs.view", params=params, timeout=20)
-    search_data = response.json()
+    search_data = await _request_json("getRandomSongs.view", search_params)
 
     results: list[Song] = []
-    for item in search_data["subsonic-response"]["randomSongs"]["song"]:
-        results.append(Song(item))
+    for item in search_data["subsonic-response"]["randomSongs"].get("song", []):
+        results.append(Song.from_json(item))
 
     return results
 
-def get_similar_songs(song_id: str, count: int=50) -> list[Song]:
+async def get_similar_songs(song_id: str, count: int=50) -> list[Song]:
     ''' Request similar songs from the subsonic API '''
 
     search_params = {
@@ -279,53 +525,85 @@ def get_similar_songs(song_id: str, count: int=50) -> list[Song]:
         "count": count
     }
 
-    params = SUBSONIC_REQUEST_PARAMS | search_params
-    response = requests.get(f"{env.SUBSONIC_SERVER}/rest/getSimilarSongs2.view", params=params, timeout=20)
-    search_data = response.json()
+    search_data = await _request_json("getSimilarSongs2.view", search_params)
 
     results: list[Song] = []
-    for item in search_data["subsonic-response"]["similarSongs2"]["song"]:
-        results.append(Song(item))
+    for item in search_data["subsonic-response"]["similarSongs2"].get("song", []):
+        results.append(Song.from_json(item))
 
     return results
 
-def get_album_songs(album: Album) -> list[Song]:
+async def get_album_songs(album: Album) -> list[Song]:
     ''' Request the songs of an album from the subsonic API '''
     params = {
         "id": album.album_id
     }
-    params = SUBSONIC_REQUEST_PARAMS | params
-    response = requests.get(f"{env.SUBSONIC_SERVER}/rest/getAlbum", params=params, timeout=20)
-    album_data = response.json()
+
+    cached = response_cache.get("getAlbum", params)
+    if cached is not None:
+        return cached
+
+    album_data = await _request_json("getAlbum", params)
 
     results: list[Song] = []
     for item in album_data["subsonic-response"]["album"]["song"]:
-        results.append(Song(item))
+        results.append(Song.from_json(item))
+
+    response_cache.put("getAlbum", params, results)
     return results
 
-def get_artist_albums(artist: Artist) -> list[Album]:
+async def get_artist_albums(artist: Artist) -> list[Album]:
     ''' Request the albums of an artist from the subsonic API '''
     params = {
         "id": artist.artist_id
     }
-    params = SUBSONIC_REQUEST_PARAMS | params
-    response = requests.get(f"{env.SUBSONIC_SERVER}/rest/getArtist", params=params, timeout=20)
-    artist_data = response.json()
+
+    cached = response_cache.get("getArtist", params)
+    if cached is not None:
+        return cached
+
+    artist_data = await _request_json("getArtist", params)
 
     results: list[Album] = []
     for item in artist_data["subsonic-response"]["artist"]["album"]:
         results.append(Album(item))
+
+    response_cache.put("getArtist", params, results)
     return results
 
-def stream(stream_id: str):
-    ''' Send a stream request to the subsonic API '''
+def stream(stream_id: str, *, max_bitrate: int=None, stream_format: str=None, time_offset: int=None) -> str:
+    ''' Builds the URL used to stream a song from the subsonic API, without sending any request '''
 
-    stream_params = {
+    stream_params: dict[str, any] = {
         "id": stream_id
-        # TODO: handle other params
     }
 
-    params = SUBSONIC_REQUEST_PARAMS | stream_params
-    response = requests.get(f"{env.SUBSONIC_SERVER}/rest/stream.view", params=params, timeout=20, stream=True)
+    # Handle Optional params
+    if max_bitrate:
+        stream_params["maxBitRate"] = max_bitrate
+
+    if stream_format is not None:
+        stream_params["format"] = stream_format
+
+    if time_offset:
+        stream_params["timeOffset"] = time_offset
+
+    params = request_params() | stream_params
+    return f"{env.SUBSONIC_SERVER}/rest/stream.view?{urlencode(params)}"
+
+def local_path(song: Song) -> str:
+    ''' Maps a song's path on the Subsonic server to the locally mounted library. Returns None if the file isn't available locally '''
+
+    if env.LOCAL_MUSIC_ROOT is None or not song.path:
+        return None
+
+    # Strip the server's library prefix, then resolve the remainder against the local mount
+    relative_path = song.path.removeprefix(env.LOCAL_MUSIC_PREFIX).lstrip("/")
+    root = os.path.realpath(env.LOCAL_MUSIC_ROOT)
+    path = os.path.realpath(os.path.join(root, relative_path))
+
+    # Never open files outside the library, even if the server returns an unexpected path
+    if os.path.commonpath((root, path)) != root or not os.path.isfile(path):
+        return None
 
-    return response.url
+    return path
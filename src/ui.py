@@ -1,80 +1,156 @@
 ''' For complex UI-related tasks '''
 
+import asyncio
 import discord
+import time
 
 import data
+import outbox
 import subsonic
 import logging
 
+from collections import OrderedDict
 from typing import Union
+from urllib.parse import urlparse, parse_qs
 
 logger = logging.getLogger(__name__)
 
 
+class AttachmentUrlCache:
+    ''' Remembers the Discord CDN URLs of uploaded cover art, so each cover only needs to be uploaded once '''
+
+    # Uploads are repeated this many seconds before a signed CDN URL expires
+    EXPIRY_MARGIN = 60 * 60
+
+    def __init__(self, max_entries: int) -> None:
+        self._max_entries = max_entries
+        self._urls: OrderedDict[str, tuple[str, float]] = OrderedDict()
+
+    def get(self, cover_id: str) -> str:
+        ''' Returns the CDN URL for a cover, or None if the cover has to be uploaded '''
+        entry = self._urls.get(cover_id)
+        if entry is None:
+            return None
+
+        url, expires_at = entry
+        if expires_at - self.EXPIRY_MARGIN < time.time():
+            del self._urls[cover_id]
+            return None
+
+        self._urls.move_to_end(cover_id)
+        return url
+
+    def put(self, cover_id: str, url: str) -> None:
+        ''' Records the CDN URL a cover was uploaded to '''
+        self._urls[cover_id] = (url, self._expiry(url))
+        self._urls.move_to_end(cover_id)
+
+        while len(self._urls) > self._max_entries:
+            self._urls.popitem(last=False)
+
+    def remember(self, cover_id: str, message: discord.Message) -> None:
+        ''' Records the CDN URL of the thumbnail uploaded with a message '''
+        if cover_id is None or message is None or len(message.embeds) == 0:
+            return
+
+        url = message.embeds[0].thumbnail.url
+        if url is not None and not url.startswith("attachment://"):
+            self.put(cover_id, url)
+
+    @staticmethod
+    def _expiry(url: str) -> float:
+        # Signed CDN URLs carry their expiry time as a hex timestamp in the `ex` parameter
+        try:
+            return int(parse_qs(urlparse(url).query)["ex"][0], 16)
+        except (KeyError, ValueError):
+            return time.time() + 24 * 60 * 60
+
+attachment_urls = AttachmentUrlCache(max_entries=10000)
+
+async def _attach_thumbnail(embed: discord.Embed, thumbnail: str, cover_id: str) -> discord.File:
+    ''' Sets an embed's thumbnail, reusing a previous upload of the cover if possible. Returns the file to upload, if any '''
+
+    # Point at the previously uploaded cover art if we know its URL
+    if cover_id is not None:
+        url = attachment_urls.get(cover_id)
+        if url is not None:
+            embed.set_thumbnail(url=url)
+            return discord.utils.MISSING
+
+        if thumbnail is None:
+            thumbnail = await subsonic.get_album_art_file(cover_id)
+
+    # Attach a thumbnail if one was provided (as a local file)
+    if thumbnail is None:
+        return discord.utils.MISSING
+
+    embed.set_thumbnail(url="attachment://image.png")
+    return discord.File(thumbnail, filename="image.png")
+
 
 class SysMsg:
     ''' A class for sending system messages '''
 
     @staticmethod
-    async def msg(messageable: discord.abc.Messageable, header: str, message: str=None, thumbnail: str=None) -> None:
-        ''' Generic message function. Creates a message formatted as an embed '''
+    async def msg(messageable: discord.abc.Messageable, header: str, message: str=None, thumbnail: str=None, cover_id: str=None,
+                  key: str=None, priority: outbox.Priority=outbox.Priority.NORMAL) -> None:
+        ''' Generic message function. Creates a message formatted as an embed and queues it for delivery to the channel
 
-        embed = discord.Embed(color=discord.Color.orange(), title=header, description=message)
-        file = discord.utils.MISSING
+        Messages sharing a key are coalesced, so a burst of them is delivered as one message.
+        '''
 
-        # Attach a thumbnail if one was provided (as a local file)
-        if thumbnail is not None:
-            file = discord.File(thumbnail, filename="image.png")
-            embed.set_thumbnail(url="attachment://image.png")
+        async def render(editing: bool) -> tuple[discord.Embed, discord.File]:
+            embed = discord.Embed(color=discord.Color.orange(), title=header, description=message)
 
-        # Attempt to send the message, up to 3 times
-        attempt = 0
-        while attempt < 3:
-            try:
-                await messageable.send(file=file, embed=embed, silent = True)
-                return
-            except discord.NotFound:
-                logger.warning("Attempt %d at sending a system message failed...", attempt+1)
-                attempt += 1
+            # An edited message replaces its attachment, so upload the cover again rather than pointing at another message's copy
+            if editing and thumbnail is None and cover_id is not None:
+                return embed, await _attach_thumbnail(embed, await subsonic.get_album_art_file(cover_id), None)
+
+            return embed, await _attach_thumbnail(embed, thumbnail, cover_id)
+
+        def on_sent(sent: discord.Message) -> None:
+            if cover_id is not None and sent.attachments:
+                attachment_urls.remember(cover_id, sent)
+
+        outbox.post(messageable, outbox.Outgoing(render, key, priority, on_sent))
 
     @staticmethod
     async def playing(messageable: discord.abc.Messageable, song: subsonic.Song) -> None:
         ''' Sends a message containing the currently playing song '''
-        cover_art = subsonic.get_album_art_file(song.cover_id)
         desc = f"**{song.title}** - *{song.artist}*\n{song.album} ({song.duration_printable})"
-        await __class__.msg(messageable, "Playing:", desc, cover_art)
+        await __class__.msg(messageable, "Playing:", desc, cover_id=song.cover_id, key="playing")
 
     @staticmethod
     async def playback_ended(messageable: discord.abc.Messageable) -> None:
         ''' Sends a message indicating playback has ended '''
-        await __class__.msg(messageable, "Playback ended")
+        await __class__.msg(messageable, "Playback ended", priority=outbox.Priority.HIGH)
 
 class CmdRsp:
     ''' A class for sending basic responses to slash commands '''
     @staticmethod
-    async def msg(interaction: discord.Interaction, header: str, message: str=None, thumbnail: str=None) -> None:
+    async def msg(interaction: discord.Interaction, header: str, message: str=None, thumbnail: str=None, cover_id: str=None) -> None:
         ''' Generic message function. Creates a message formatted as an embed '''
 
         embed = discord.Embed(color=discord.Color.orange(), title=header, description=message)
-        file = discord.utils.MISSING
-
-        # Attach a thumbnail if one was provided (as a local file)
-        if thumbnail is not None:
-            file = discord.File(thumbnail, filename="image.png")
-            embed.set_thumbnail(url="attachment://image.png")
+        file = await _attach_thumbnail(embed, thumbnail, cover_id)
 
         # Attempt to send the error message, up to 3 times
         attempt = 0
         while attempt < 3:
             try:
                 if interaction.response.is_done():
-                    await interaction.followup.send(file=file, embed=embed)
+                    sent = await interaction.followup.send(file=file, embed=embed, wait=True)
                 else:
                     await interaction.response.send_message(file=file, embed=embed)
+                    sent = await interaction.original_response() if file is not discord.utils.MISSING else None
+                if file is not discord.utils.MISSING:
+                    attachment_urls.remember(cover_id, sent)
                 return
             except discord.NotFound:
                 logger.warning("Attempt %d at sending a command response failed...", attempt+1)
                 attempt += 1
+                if attempt < 3:
+                    await asyncio.sleep(outbox.backoff_delay(attempt))
 
     @staticmethod
     async def starting_queue_playback(interaction: discord.Interaction) -> None:
@@ -102,11 +178,48 @@ class CmdRsp:
         ''' Sends a message indicating the current song was skipped '''
         await __class__.msg(interaction, "Skipped track")
 
+    @staticmethod
+    async def seeking(interaction: discord.Interaction, position: int) -> None:
+        ''' Sends a message indicating the current song was moved to a new position '''
+        await __class__.msg(interaction, f"Seeked to {(position // 60):02d}:{(position % 60):02d}")
+
     @staticmethod
     async def disconnected(interaction: discord.Interaction) -> None:
         ''' Sends a message indicating the bot disconnected from voice channel '''
         await __class__.msg(interaction, "Disconnected from voice channel")
 
+class ProgressMsg:
+    ''' A response to a slash command which is edited in place to report the progress of a long-running action '''
+
+    # Edits are spaced at least this many seconds apart, to stay clear of Discord's rate limits
+    MIN_EDIT_INTERVAL = 1.0
+
+    def __init__(self, interaction: discord.Interaction, header: str) -> None:
+        self._interaction = interaction
+        self._header = header
+        self._message: discord.WebhookMessage = None
+        self._edited_at: float = 0
+
+    async def update(self, message: str, *, final: bool=False) -> None:
+        ''' Shows the latest progress. Intermediate updates arriving too quickly are skipped, but the final update is always shown '''
+        if not final and time.monotonic() - self._edited_at < self.MIN_EDIT_INTERVAL:
+            return
+
+        embed = discord.Embed(color=discord.Color.orange(), title=self._header, description=message)
+        self._edited_at = time.monotonic()
+
+        try:
+            if self._message is None:
+                if self._interaction.response.is_done():
+                    self._message = await self._interaction.followup.send(embed=embed, wait=True)
+                else:
+                    await self._interaction.response.send_message(embed=embed)
+                    self._message = await self._interaction.original_response()
+            else:
+                await self._message.edit(embed=embed)
+        except discord.HTTPException as err:
+            logger.warning("Failed to update a progress message.", exc_info=err)
+
 class CmdErr:
     ''' A class for sending error messages in response to slash commands '''
 
@@ -120,6 +233,26 @@ class CmdErr:
         else:
             await interaction.response.send_message(embed=embed, ephemeral=True)
 
+    @staticmethod
+    async def too_busy(interaction: discord.Interaction) -> None:
+        ''' Sends an error message indicating too many commands are still being handled '''
+        await __class__.msg(interaction, "Too many commands are still being handled, please try again in a moment.")
+
+    @staticmethod
+    async def server_unreachable(interaction: discord.Interaction) -> None:
+        ''' Sends an error message indicating the Subsonic server could not be reached '''
+        await __class__.msg(interaction, "Could not reach the music server, please try again later.")
+
+    @staticmethod
+    async def command_failed(interaction: discord.Interaction) -> None:
+        ''' Sends an error message indicating a command failed unexpectedly '''
+        await __class__.msg(interaction, "Something went wrong while handling this command, please try again.")
+
+    @staticmethod
+    async def results_expired(interaction: discord.Interaction) -> None:
+        ''' Sends an error message indicating the results shown by a message are no longer available '''
+        await __class__.msg(interaction, "These results are no longer available, please search again.")
+
     @staticmethod
     async def user_not_in_voice_channel(interaction: discord.Interaction) -> None:
         ''' Sends an error message indicating user is not in a voice channel '''
@@ -150,6 +283,16 @@ class CmdErr:
         ''' Sends an error message indicating nothing is playing '''
         await __class__.msg(interaction, "No track is playing.")
 
+    @staticmethod
+    async def invalid_position(interaction: discord.Interaction) -> None:
+        ''' Sends an error message indicating a position is not within the current song '''
+        await __class__.msg(interaction, "Position must be within the current track, as seconds or mm:ss.")
+
+    @staticmethod
+    async def cannot_seek(interaction: discord.Interaction) -> None:
+        ''' Sends an error message indicating the current song could not be restarted at a new position '''
+        await __class__.msg(interaction, "Cannot seek in the current track.")
+
 
 
 def parse_subsonic_items_as_selection_embed(items: list[Union[subsonic.Song, subsonic.Album, subsonic.Artist]], header: str, footer: str) -> list[discord.SelectOption]:
@@ -203,3 +346,20 @@ def parse_subsonic_items_as_selection_options(items: list[Union[subsonic.Song, s
         select_option = discord.SelectOption(label=select_label, description=select_desc, value=i)
         select_options.append(select_option)
     return select_options
+
+def parse_queue_page_as_embed(songs: list[subsonic.Song], start: int, page: int, page_count: int, queue_length: int, queue_duration: int) -> discord.Embed:
+    ''' Takes one page of the queue, starting at position `start`, and parses it into a Discord embed '''
+
+    # Trim each tag so that a full page always fits within the embed's 4096 character limit
+    def trim(text: str, length: int=90) -> str:
+        return (text[:length - 3] + "...") if len(text) > length else text
+
+    entries = [f"{start + i + 1}. **{trim(song.title)}** - *{trim(song.artist)}*\n{trim(song.album)} ({song.duration_printable})"
+               for i, song in enumerate(songs)]
+
+    hours, seconds = divmod(queue_duration, 3600)
+    total = f"{hours}:{(seconds // 60):02d}:{(seconds % 60):02d}" if hours else f"{(seconds // 60):02d}:{(seconds % 60):02d}"
+
+    embed = discord.Embed(color=discord.Color.orange(), title="Queue", description="\n\n".join(entries))
+    embed.set_footer(text=f"Page {page + 1} of {page_count} | {queue_length} tracks, {total}")
+    return embed
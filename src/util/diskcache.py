@@ -0,0 +1,195 @@
+''' A size-bounded on-disk file cache with LRU eviction '''
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class DiskCache():
+    ''' A cache of files stored in sharded subdirectories, bounded by a total size in bytes
+
+    The cache's contents are tracked by an in-memory index, so lookups never touch the filesystem.
+    The index is persisted to disk periodically, and when the cache is flushed.
+    '''
+
+    INDEX_FILENAME = "index.json"
+    INDEX_SAVE_INTERVAL = 10
+
+    def __init__(self, root: str, max_bytes: int, suffix: str="") -> None:
+        self.root = root
+        self.max_bytes = max_bytes
+        self.suffix = suffix
+
+        self._index: OrderedDict[str, dict] = OrderedDict()
+        self._total_bytes: int = 0
+        self._lock = threading.RLock()
+        self._index_dirty: bool = False
+        self._index_saved_at: float = 0
+
+        self.hits: int = 0
+        self.misses: int = 0
+        self.evictions: int = 0
+
+        self._load_index()
+
+    @property
+    def total_bytes(self) -> int:
+        ''' The combined size of all cached files, in bytes '''
+        return self._total_bytes
+
+    def path(self, key: str) -> str:
+        ''' Returns the path a key's file is (or would be) stored at '''
+        digest = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.root, digest[:2], digest + self.suffix)
+
+    def lookup(self, key: str) -> dict:
+        ''' Returns the metadata stored alongside a cached key and marks it as recently used, or None if the key is not cached '''
+        with self._lock:
+            entry = self._index.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self._index.move_to_end(key)
+            self._index_dirty = True
+            self.hits += 1
+            return entry["meta"]
+
+    def temp_path(self, key: str) -> str:
+        ''' Creates and returns an empty temporary file next to a key's final location, to be filled and passed to `commit` '''
+        target = self.path(key)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+
+        fd, temp = tempfile.mkstemp(dir=os.path.dirname(target), suffix=".tmp")
+        os.close(fd)
+        return temp
+
+    def write(self, key: str, content: bytes, meta: dict=None) -> str:
+        ''' Atomically stores the content for a key and returns the path of the cached file '''
+        temp = self.temp_path(key)
+        with open(temp, "wb") as file:
+            file.write(content)
+
+        return self.commit(key, temp, meta)
+
+    def commit(self, key: str, temp: str, meta: dict=None) -> str:
+        ''' Moves a completed temporary file into place for a key, then evicts entries until the cache is within budget '''
+        target = self.path(key)
+        size = os.path.getsize(temp)
+        os.replace(temp, target)
+
+        with self._lock:
+            if key in self._index:
+                self._total_bytes -= self._index.pop(key)["bytes"]
+
+            self._index[key] = {"bytes": size, "meta": meta or {}}
+            self._total_bytes += size
+
+            while self._total_bytes > self.max_bytes and len(self._index) > 1:
+                self._evict(next(iter(self._index)))
+                self.evictions += 1
+
+            self._index_dirty = True
+            self._save_index_if_due()
+
+        return target
+
+    def update_meta(self, key: str, meta: dict) -> None:
+        ''' Merges new metadata into a cached key's existing metadata '''
+        with self._lock:
+            entry = self._index.get(key)
+            if entry is not None:
+                entry["meta"].update(meta)
+                self._index_dirty = True
+
+    def discard(self, temp: str) -> None:
+        ''' Removes a temporary file that will not be committed '''
+        try:
+            os.remove(temp)
+        except FileNotFoundError:
+            pass
+
+    def remove(self, key: str) -> None:
+        ''' Removes a key and its file from the cache '''
+        with self._lock:
+            if key in self._index:
+                self._evict(key)
+                self._index_dirty = True
+
+    def stats(self) -> dict[str, int]:
+        ''' Returns counters describing the cache's usage '''
+        return {
+            "entries": len(self._index),
+            "bytes": self._total_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / (self.hits + self.misses), 3) if self.hits + self.misses > 0 else 0,
+            "evictions": self.evictions,
+        }
+
+    def flush(self) -> None:
+        ''' Writes the index to disk if it has changed '''
+        with self._lock:
+            if self._index_dirty:
+                self._save_index()
+
+    def _evict(self, key: str) -> None:
+        entry = self._index.pop(key)
+        self._total_bytes -= entry["bytes"]
+
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    def _save_index_if_due(self) -> None:
+        if time.monotonic() - self._index_saved_at >= self.INDEX_SAVE_INTERVAL:
+            self._save_index()
+
+    def _save_index(self) -> None:
+        os.makedirs(self.root, exist_ok=True)
+        entries = [[key, entry["bytes"], entry["meta"]] for key, entry in self._index.items()]
+
+        fd, temp = tempfile.mkstemp(dir=self.root, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as file:
+                json.dump(entries, file)
+            os.replace(temp, os.path.join(self.root, self.INDEX_FILENAME))
+        except OSError as err:
+            logger.error("Failed to save the index of the cache at '%s'.", self.root, exc_info=err)
+            self.discard(temp)
+            return
+
+        self._index_dirty = False
+        self._index_saved_at = time.monotonic()
+
+    def _load_index(self) -> None:
+        index_path = os.path.join(self.root, self.INDEX_FILENAME)
+        if not os.path.exists(index_path):
+            return
+
+        try:
+            with open(index_path, "r", encoding="utf-8") as file:
+                entries = json.load(file)
+        except (OSError, ValueError) as err:
+            logger.error("Failed to load the index of the cache at '%s'. Starting with an empty cache.", self.root, exc_info=err)
+            return
+
+        # Validate the index once at startup, so the hot path never has to check the filesystem
+        for key, size, meta in entries:
+            if os.path.exists(self.path(key)):
+                self._index[key] = {"bytes": size, "meta": meta}
+                self._total_bytes += size
+            else:
+                self._index_dirty = True
+
+        logger.info("Loaded %d entries (%d bytes) into the cache at '%s'.", len(self._index), self._total_bytes, self.root)
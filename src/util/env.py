@@ -14,3 +14,45 @@ DISCORD_OWNER_ID: Final[int] = int(os.getenv("DISCORD_OWNER_ID"))
 SUBSONIC_SERVER: Final[str] = os.getenv("SUBSONIC_SERVER")
 SUBSONIC_USER: Final[str] = os.getenv("SUBSONIC_USER")
 SUBSONIC_PASSWORD: Final[str] = os.getenv("SUBSONIC_PASSWORD")
+
+SUBSONIC_MAX_CONNECTIONS: Final[int] = int(os.getenv("SUBSONIC_MAX_CONNECTIONS", "16"))
+SUBSONIC_KEEPALIVE_TIMEOUT: Final[float] = float(os.getenv("SUBSONIC_KEEPALIVE_TIMEOUT", "60"))
+SUBSONIC_CONNECT_TIMEOUT: Final[float] = float(os.getenv("SUBSONIC_CONNECT_TIMEOUT", "5"))
+SUBSONIC_READ_TIMEOUT: Final[float] = float(os.getenv("SUBSONIC_READ_TIMEOUT", "20"))
+SUBSONIC_TOKEN_AUTH: Final[bool] = os.getenv("SUBSONIC_TOKEN_AUTH", "false").lower() in ("1", "true", "yes")
+SUBSONIC_MAX_BITRATE: Final[int] = int(os.getenv("SUBSONIC_MAX_BITRATE", "0"))
+SUBSONIC_STREAM_FORMAT: Final[str] = os.getenv("SUBSONIC_STREAM_FORMAT")
+SUBSONIC_CACHE_MAX_ITEMS: Final[int] = int(os.getenv("SUBSONIC_CACHE_MAX_ITEMS", "20000"))
+ART_CACHE_MAX_BYTES: Final[int] = int(os.getenv("ART_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+ART_CACHE_REVALIDATE_AFTER: Final[int] = int(os.getenv("ART_CACHE_REVALIDATE_AFTER", str(24 * 60 * 60)))
+STORAGE_FLUSH_INTERVAL: Final[float] = float(os.getenv("STORAGE_FLUSH_INTERVAL", "5"))
+PREFETCH_LEAD_SECONDS: Final[int] = int(os.getenv("PREFETCH_LEAD_SECONDS", "15"))
+PREFETCH_PACKETS: Final[int] = int(os.getenv("PREFETCH_PACKETS", "50"))
+CONTINUOUS_PLAYBACK: Final[bool] = os.getenv("CONTINUOUS_PLAYBACK", "false").lower() in ("1", "true", "yes")
+CONTINUOUS_BUFFER_CHUNKS: Final[int] = int(os.getenv("CONTINUOUS_BUFFER_CHUNKS", "16"))
+SUBSONIC_OPUS_PASSTHROUGH: Final[bool] = os.getenv("SUBSONIC_OPUS_PASSTHROUGH", "false").lower() in ("1", "true", "yes")
+SUBSONIC_OPUS_BITRATE: Final[int] = int(os.getenv("SUBSONIC_OPUS_BITRATE", "128"))
+AUDIO_CACHE_MAX_BYTES: Final[int] = int(os.getenv("AUDIO_CACHE_MAX_BYTES", str(2 * 1024 * 1024 * 1024)))
+READAHEAD_BYTES: Final[int] = int(os.getenv("READAHEAD_BYTES", "0"))
+READAHEAD_MAX_RETRIES: Final[int] = int(os.getenv("READAHEAD_MAX_RETRIES", "5"))
+LOCAL_MUSIC_ROOT: Final[str] = os.getenv("LOCAL_MUSIC_ROOT")
+LOCAL_MUSIC_PREFIX: Final[str] = os.getenv("LOCAL_MUSIC_PREFIX", "")
+AUTOPLAY_BATCH_SIZE: Final[int] = int(os.getenv("AUTOPLAY_BATCH_SIZE", "50"))
+AUTOPLAY_LOW_WATER: Final[int] = int(os.getenv("AUTOPLAY_LOW_WATER", "10"))
+AUTOPLAY_RECENT_HISTORY: Final[int] = int(os.getenv("AUTOPLAY_RECENT_HISTORY", "200"))
+RECOMMEND_WINDOW: Final[int] = int(os.getenv("RECOMMEND_WINDOW", "5"))
+RECOMMEND_HISTORY_LIMIT: Final[int] = int(os.getenv("RECOMMEND_HISTORY_LIMIT", "100000"))
+LIBRARY_INDEX: Final[bool] = os.getenv("LIBRARY_INDEX", "false").lower() in ("1", "true", "yes")
+LIBRARY_SYNC_INTERVAL: Final[float] = float(os.getenv("LIBRARY_SYNC_INTERVAL", str(60 * 60)))
+LIBRARY_SERVER_FALLBACK: Final[bool] = os.getenv("LIBRARY_SERVER_FALLBACK", "true").lower() in ("1", "true", "yes")
+AUTOCOMPLETE_SERVER_LOOKUP: Final[bool] = os.getenv("AUTOCOMPLETE_SERVER_LOOKUP", "true").lower() in ("1", "true", "yes")
+AUTOCOMPLETE_DEBOUNCE: Final[float] = float(os.getenv("AUTOCOMPLETE_DEBOUNCE", "0.3"))
+AUTOCOMPLETE_TIMEOUT: Final[float] = float(os.getenv("AUTOCOMPLETE_TIMEOUT", "2"))
+AUTOCOMPLETE_CACHE_TTL: Final[float] = float(os.getenv("AUTOCOMPLETE_CACHE_TTL", "60"))
+AUTOCOMPLETE_CACHE_MAX_ITEMS: Final[int] = int(os.getenv("AUTOCOMPLETE_CACHE_MAX_ITEMS", "5000"))
+PLAY_ALL_CONCURRENCY: Final[int] = int(os.getenv("PLAY_ALL_CONCURRENCY", "4"))
+MAX_TASKS_PER_USER: Final[int] = int(os.getenv("MAX_TASKS_PER_USER", "2"))
+MAX_TASKS_PER_GUILD: Final[int] = int(os.getenv("MAX_TASKS_PER_GUILD", "8"))
+VIEW_TIMEOUT: Final[float] = float(os.getenv("VIEW_TIMEOUT", "900"))
+MAX_LIVE_VIEWS: Final[int] = int(os.getenv("MAX_LIVE_VIEWS", "500"))
+MAX_VIEW_CURSORS: Final[int] = int(os.getenv("MAX_VIEW_CURSORS", "20000"))
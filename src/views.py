@@ -0,0 +1,135 @@
+''' Bounded storage for the results shown by interactive messages '''
+
+import asyncio
+import secrets
+import sys
+import time
+
+from collections import OrderedDict
+
+from util import env
+
+
+def approximate_size(obj: object, seen: set[int]=None) -> int:
+    ''' Estimates the memory retained by an object, following containers, slotted objects, instance dictionaries and finished tasks '''
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    if isinstance(obj, asyncio.Future):
+        done = obj.done() and not obj.cancelled() and obj.exception() is None
+        return approximate_size(obj.result(), seen) if done else 0
+
+    size = sys.getsizeof(obj)
+
+    if isinstance(obj, (str, bytes, int, float, bool, type(None))):
+        return size
+    if isinstance(obj, dict):
+        return size + sum(approximate_size(key, seen) + approximate_size(value, seen) for key, value in obj.items())
+    if isinstance(obj, (list, tuple, set, frozenset)):
+        return size + sum(approximate_size(item, seen) for item in obj)
+
+    for cls in type(obj).__mro__:
+        for slot in getattr(cls, "__slots__", ()):
+            if not slot.startswith("__") and hasattr(obj, slot):
+                size += approximate_size(getattr(obj, slot), seen)
+
+    if hasattr(obj, "__dict__"):
+        size += approximate_size(vars(obj), seen)
+
+    return size
+
+
+class ViewRegistry():
+    ''' The results behind each live interactive message, so its components can be answered without fetching them again
+
+    A view is identified by a short token carried in the custom IDs of its components. Views expire once unused for a while,
+    and the least recently used views are evicted once too many are live, releasing their results. A component whose view
+    has gone rehydrates its results from a compact cursor, either stored here or carried in its custom ID.
+    '''
+
+    __slots__ = ("_timeout", "_max_views", "_max_cursors", "_views", "_cursors", "_expired", "_evicted", "_rehydrated")
+
+    def __init__(self, timeout: float, max_views: int, max_cursors: int) -> None:
+        self._timeout = timeout
+        self._max_views = max_views
+        self._max_cursors = max_cursors
+
+        # Each live view's results and when it was last used, least recently used first
+        self._views: OrderedDict[str, tuple[object, float]] = OrderedDict()
+
+        # Cursors outlive their views, as they are tiny and let an expired view be rebuilt
+        self._cursors: OrderedDict[str, tuple] = OrderedDict()
+
+        self._expired: int = 0
+        self._evicted: int = 0
+        self._rehydrated: int = 0
+
+    def register(self, results: object, cursor: tuple=None, token: str=None) -> str:
+        ''' Stores the results behind a view, and optionally the cursor needed to rebuild them. Returns the view's token '''
+        if token is None:
+            token = secrets.token_hex(4)
+
+        self._views[token] = (results, time.monotonic())
+        self._views.move_to_end(token)
+
+        if cursor is not None:
+            self._cursors[token] = cursor
+            self._cursors.move_to_end(token)
+            while len(self._cursors) > self._max_cursors:
+                self._cursors.popitem(last=False)
+
+        self._expire()
+        while len(self._views) > self._max_views:
+            self._views.popitem(last=False)
+            self._evicted += 1
+
+        return token
+
+    def results(self, token: str) -> object:
+        ''' Returns the results behind a live view and marks it as used, or None if the view has expired '''
+        self._expire()
+
+        entry = self._views.get(token)
+        if entry is None:
+            return None
+
+        self._views[token] = (entry[0], time.monotonic())
+        self._views.move_to_end(token)
+        return entry[0]
+
+    def cursor(self, token: str) -> tuple:
+        ''' Returns the cursor stored for a view, or None if it has been forgotten '''
+        cursor = self._cursors.get(token)
+        if cursor is not None:
+            self._cursors.move_to_end(token)
+        return cursor
+
+    def rehydrated(self, token: str, results: object) -> None:
+        ''' Stores the results rebuilt for an expired view, making it live again '''
+        self._rehydrated += 1
+        self.register(results, token=token)
+
+    def _expire(self) -> None:
+        ''' Forgets views which have gone unused for longer than the timeout. Views are ordered by last use, so only the oldest need checking '''
+        deadline = time.monotonic() - self._timeout
+        while self._views and next(iter(self._views.values()))[1] < deadline:
+            self._views.popitem(last=False)
+            self._expired += 1
+
+    def stats(self) -> dict[str, int]:
+        ''' Returns the number of live views, an estimate of the memory their results retain and how views have been released and rebuilt '''
+        self._expire()
+        return {
+            "live": len(self._views),
+            "retained_bytes": sum(approximate_size(results) for results, _ in self._views.values()),
+            "cursors": len(self._cursors),
+            "expired": self._expired,
+            "evicted": self._evicted,
+            "rehydrated": self._rehydrated,
+        }
+
+
+registry = ViewRegistry(env.VIEW_TIMEOUT, env.MAX_LIVE_VIEWS, env.MAX_VIEW_CURSORS)